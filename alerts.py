@@ -0,0 +1,226 @@
+"""
+Geofenced arrival alerts
+
+Clients register rules such as "line 116 within 500 m of this stop" and
+receive an event when a bus of the line enters the circle. Every snapshot
+evaluates all active rules in one batched spatial join: buses are bucketed
+into a grid keyed by (line, cell), and the 3x3 cells around every rule are
+kept sorted, so matching is one searchsorted per bus. No per-rule Python
+code runs per snapshot.
+
+A rule fires once when a bus enters and re-arms when no bus of the line is
+inside any more. Events are queued per client and delivered by the
+Server-Sent Events stream in app.py.
+"""
+import itertools
+import queue
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+import snapshots
+from analytics import METERS_PER_DEGREE
+
+# Grid cells as large as the biggest radius, so a 3x3 block covers a circle
+MAX_RADIUS_M = 2000
+MIN_RADIUS_M = 50
+SUBSCRIPTION_TTL_S = 4 * 3600
+CLIENT_QUEUE_SIZE = 100
+REFERENCE_LATITUDE = -34.9  # Montevideo
+
+_CELL_OFFSET = 1 << 20
+_NEIGHBOURS = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+
+
+def project(latitude, longitude):
+    x = np.asarray(longitude, dtype=np.float64) * METERS_PER_DEGREE * np.cos(np.radians(REFERENCE_LATITUDE))
+    y = np.asarray(latitude, dtype=np.float64) * METERS_PER_DEGREE
+    return x, y
+
+
+def cell_key(line, cell_x, cell_y):
+    """Pack (line, cell_x, cell_y) into one sortable int64"""
+    return (
+        (np.asarray(line, dtype=np.int64) << 42)
+        | ((np.asarray(cell_x, dtype=np.int64) + _CELL_OFFSET) << 21)
+        | (np.asarray(cell_y, dtype=np.int64) + _CELL_OFFSET)
+    )
+
+
+class AlertBook:
+    """
+    Active subscriptions and per-client event queues
+    """
+
+    def __init__(self):
+        self._subscriptions = {}
+        self._queues = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._dirty = True
+        self._columns = None
+
+    def subscribe(self, client, line, latitude, longitude, radius, stop=None):
+        """Register a rule and return it as a dict"""
+        radius = min(max(float(radius), MIN_RADIUS_M), MAX_RADIUS_M)
+        with self._lock:
+            subscription = {
+                "id": next(self._ids),
+                "client": client,
+                "line": str(line),
+                "stop": stop,
+                "latitude": float(latitude),
+                "longitude": float(longitude),
+                "radius": radius,
+                "expires_at": time.time() + SUBSCRIPTION_TTL_S
+            }
+            self._subscriptions[subscription["id"]] = subscription
+            self._queues.setdefault(client, queue.Queue(maxsize=CLIENT_QUEUE_SIZE))
+            self._dirty = True
+        return subscription
+
+    def unsubscribe(self, client, subscription_id):
+        """Remove a client's rule; returns False if there was no such rule"""
+        with self._lock:
+            subscription = self._subscriptions.get(subscription_id)
+            if not subscription or subscription["client"] != client:
+                return False
+            del self._subscriptions[subscription_id]
+            self._dirty = True
+        return True
+
+    def subscriptions(self, client):
+        with self._lock:
+            return [s for s in self._subscriptions.values() if s["client"] == client]
+
+    def lines(self):
+        """Lines with at least one active subscription"""
+        with self._lock:
+            return {s["line"] for s in self._subscriptions.values()}
+
+    def events(self, client):
+        """Event queue of a client, or None for unknown clients"""
+        return self._queues.get(client)
+
+    def evaluate(self, snapshot):
+        """
+        Check every subscription against a snapshot and queue the events
+
+        Returns the number of events queued.
+        """
+        with self._lock:
+            if self._columns is not None and len(self._columns["id"]) and self._columns["expires_at"].min() < snapshot.taken_at:
+                self._expire(snapshot.taken_at)
+            if self._dirty:
+                self._rebuild()
+            columns = self._columns
+            if not len(columns["id"]) or not len(snapshot):
+                columns["inside"][:] = False
+                return 0
+
+            # Candidate (subscription, bus) pairs: every bus looks up its own
+            # (line, cell) among the precomputed 3x3 cells around each rule
+            bus_x, bus_y = project(snapshot.latitude, snapshot.longitude)
+            bus_key = cell_key(
+                snapshot.line, np.floor(bus_x / MAX_RADIUS_M), np.floor(bus_y / MAX_RADIUS_M)
+            )
+            lo = np.searchsorted(columns["cell_key"], bus_key, side="left")
+            counts = np.searchsorted(columns["cell_key"], bus_key, side="right") - lo
+            starts = np.cumsum(counts) - counts
+            bus = np.repeat(np.arange(len(bus_key)), counts)
+            sub = columns["cell_sub"][np.repeat(lo - starts, counts) + np.arange(int(counts.sum()))]
+            sub_x, sub_y = columns["x"], columns["y"]
+
+            # Keep the pairs inside the radius, then the closest bus per rule
+            distance = np.hypot(bus_x[bus] - sub_x[sub], bus_y[bus] - sub_y[sub])
+            hit = distance <= columns["radius"][sub]
+            sub, bus, distance = sub[hit], bus[hit], distance[hit]
+            closest = np.lexsort((distance, sub))
+            sub, bus, distance = sub[closest], bus[closest], distance[closest]
+            first = np.concatenate(([True], sub[1:] != sub[:-1])) if len(sub) else np.zeros(0, dtype=bool)
+            sub, bus, distance = sub[first], bus[first], distance[first]
+
+            # Only rules that had no bus inside on the previous snapshot fire
+            fired = np.flatnonzero(~columns["inside"][sub])
+            columns["inside"][:] = False
+            columns["inside"][sub] = True
+
+            timestamp = datetime.fromtimestamp(snapshot.taken_at).isoformat()
+            for i in fired:
+                subscription = self._subscriptions[int(columns["id"][sub[i]])]
+                bus_data = snapshot.bus(bus[i])
+                self._push(subscription["client"], {
+                    "subscription": subscription["id"],
+                    "line": subscription["line"],
+                    "stop": subscription["stop"],
+                    "bus": bus_data["id"],
+                    "destination": bus_data.get("destination"),
+                    "latitude": bus_data["latitude"],
+                    "longitude": bus_data["longitude"],
+                    "distance_m": round(float(distance[i]), 1),
+                    "timestamp": timestamp
+                })
+            return len(fired)
+
+    def _push(self, client, event):
+        events = self._queues.get(client)
+        if events is None:
+            return
+        # Slow clients lose their oldest events rather than blocking the refresh
+        while True:
+            try:
+                events.put_nowait(event)
+                return
+            except queue.Full:
+                try:
+                    events.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def _expire(self, now):
+        expired = [i for i, s in self._subscriptions.items() if s["expires_at"] < now]
+        for subscription_id in expired:
+            del self._subscriptions[subscription_id]
+        if expired:
+            self._dirty = True
+            active_clients = {s["client"] for s in self._subscriptions.values()}
+            for client in list(self._queues):
+                if client not in active_clients:
+                    del self._queues[client]
+
+    def _rebuild(self):
+        subscriptions = list(self._subscriptions.values())
+        count = len(subscriptions)
+        x, y = project(
+            np.fromiter((s["latitude"] for s in subscriptions), dtype=np.float64, count=count),
+            np.fromiter((s["longitude"] for s in subscriptions), dtype=np.float64, count=count),
+        )
+        ids = np.fromiter((s["id"] for s in subscriptions), dtype=np.int64, count=count)
+        # Carry over which rules currently have a bus inside
+        inside = np.zeros(count, dtype=bool)
+        if self._columns is not None:
+            previous = self._columns
+            inside = np.isin(ids, previous["id"][previous["inside"]])
+        # The 3x3 block of cells around every rule, sorted for the join
+        # Lines come from clients, so they are looked up rather than added
+        # to the shared table; a line no bus has reported yet gets -1
+        line = np.fromiter((snapshots.lines.lookup(s["line"]) for s in subscriptions), dtype=np.int32, count=count)
+        cell_x = np.floor(x / MAX_RADIUS_M)
+        cell_y = np.floor(y / MAX_RADIUS_M)
+        keys = np.concatenate([cell_key(line, cell_x + dx, cell_y + dy) for dx, dy in _NEIGHBOURS])
+        order = np.argsort(keys)
+        self._columns = {
+            "id": ids,
+            "cell_key": keys[order],
+            "cell_sub": np.tile(np.arange(count), len(_NEIGHBOURS))[order],
+            "line": line,
+            "x": x,
+            "y": y,
+            "radius": np.fromiter((s["radius"] for s in subscriptions), dtype=np.float64, count=count),
+            "expires_at": np.fromiter((s["expires_at"] for s in subscriptions), dtype=np.float64, count=count),
+            "inside": inside,
+        }
+        # Look those lines up again on the next snapshot
+        self._dirty = bool((line < 0).any())
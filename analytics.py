@@ -0,0 +1,190 @@
+"""
+Aggregates over recorded bus positions
+
+All computations work on the columnar windows returned by
+PositionStore.window() and use NumPy sorting and bincount group-bys instead
+of Python loops, so they scale to weeks of full-fleet data. Results for
+completed time buckets never change and are kept in a BucketCache.
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEGREE = 111320.0
+
+# Consecutive fixes further apart than this are not used to estimate speed
+MAX_SPEED_GAP_S = 120
+# Anything faster is a GPS jump, not a bus
+MAX_PLAUSIBLE_SPEED_KMH = 90.0
+# Two buses of the same line and variant inside the same cell count as bunched
+BUNCHING_CELL_M = 200.0
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """Great-circle distance in meters between arrays of points"""
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(a, dtype=np.float64)) for a in (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def project(latitude, longitude, reference_latitude):
+    """Equirectangular projection to local meters, good enough at city scale"""
+    x = np.asarray(longitude, dtype=np.float64) * METERS_PER_DEGREE * np.cos(np.radians(reference_latitude))
+    y = np.asarray(latitude, dtype=np.float64) * METERS_PER_DEGREE
+    return x, y
+
+
+def vehicle_steps(window, max_gap=MAX_SPEED_GAP_S):
+    """
+    Pair each recorded fix with the previous fix of the same vehicle
+
+    Steps are short, so distances use the local projection instead of the
+    much costlier haversine formula.
+
+    Returns (index, dt, distance) where `index` points at the later fix of
+    each pair inside `window`. Pairs with gaps above `max_gap` seconds or
+    implausible speeds are dropped.
+    """
+    # Rows are already ordered by time, so a stable sort by vehicle suffices
+    order = np.argsort(window["vehicle"], kind="stable")
+    vehicle = window["vehicle"][order]
+    t = window["t"][order]
+    latitude = window["latitude"][order]
+    longitude = window["longitude"][order]
+
+    dt = np.diff(t)
+    reference_latitude = float(np.mean(latitude)) if len(latitude) else 0.0
+    dx = np.diff(longitude) * np.float32(METERS_PER_DEGREE * np.cos(np.radians(reference_latitude)))
+    dy = np.diff(latitude) * np.float32(METERS_PER_DEGREE)
+    distance = np.sqrt(dx * dx + dy * dy)
+    valid = (vehicle[1:] == vehicle[:-1]) & (dt > 0) & (dt <= max_gap)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        valid &= distance / np.maximum(dt, 1) * 3.6 <= MAX_PLAUSIBLE_SPEED_KMH
+    return order[1:][valid], dt[valid], distance[valid]
+
+
+def commercial_speed(window, n_lines, since=None):
+    """
+    Average commercial speed per line: distance covered over time elapsed
+
+    Dwell time at stops and in traffic is included, which is what makes it
+    the commercial speed rather than the average of the reported speeds.
+    Steps ending before `since` are ignored, so callers can pass a window
+    that starts a little early to keep steps crossing a bucket boundary.
+    Returns (distance_m, elapsed_s) arrays indexed by line code.
+    """
+    index, dt, distance = vehicle_steps(window)
+    if since is not None:
+        keep = window["t"][index] >= since
+        index, dt, distance = index[keep], dt[keep], distance[keep]
+    line = window["line"][index]
+    distance_m = np.bincount(line, weights=distance, minlength=n_lines)
+    elapsed_s = np.bincount(line, weights=dt, minlength=n_lines)
+    return distance_m, elapsed_s
+
+
+def bunching(window, n_lines, cell_size=BUNCHING_CELL_M):
+    """
+    Bunched observations per line
+
+    Positions are bucketed into a square grid; every bus that shares a cell
+    with another bus of the same line and variant in the same snapshot is a
+    bunched observation. Returns (bunched, observed) arrays indexed by line
+    code.
+    """
+    observed = np.bincount(window["line"], minlength=n_lines)
+    if not len(window["t"]):
+        return np.zeros(n_lines, dtype=np.int64), observed
+
+    x, y = project(window["latitude"], window["longitude"], float(np.mean(window["latitude"])))
+    cell_x = np.floor(x / cell_size).astype(np.int64)
+    cell_y = np.floor(y / cell_size).astype(np.int64)
+    cell_x -= cell_x.min()
+    cell_y -= cell_y.min()
+    # Rows are ordered by time: every change of timestamp starts a snapshot
+    snapshot_index = np.concatenate(([0], np.cumsum(np.diff(window["t"]) != 0)))
+
+    dims = (
+        int(snapshot_index.max()) + 1,
+        int(window["line"].max()) + 1,
+        int(window["subline"].max()) + 1,
+        int(cell_x.max()) + 1,
+        int(cell_y.max()) + 1,
+    )
+    key = np.ravel_multi_index((snapshot_index, window["line"], window["subline"], cell_x, cell_y), dims)
+    key.sort()
+    # A key shared with a neighbour in sorted order is a shared cell
+    shared = np.zeros(len(key), dtype=bool)
+    same = key[1:] == key[:-1]
+    shared[1:] |= same
+    shared[:-1] |= same
+    line = key // (dims[2] * dims[3] * dims[4]) % dims[1]
+    bunched = np.bincount(line[shared], minlength=n_lines)
+    return bunched, observed
+
+
+def last_seen(window):
+    """
+    Last recorded fix of every vehicle in the window
+
+    Returns (vehicle, index) arrays where `index` points at the most recent
+    row of each vehicle inside `window`.
+    """
+    vehicle = window["vehicle"]
+    codes, first_from_end = np.unique(vehicle[::-1], return_index=True)
+    return codes, len(vehicle) - 1 - first_from_end
+
+
+class BucketCache:
+    """
+    LRU cache for per-bucket aggregates
+
+    Only results for completed buckets are stored: once a snapshot newer
+    than the end of a bucket has been recorded, its rows never change.
+    """
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compute, complete):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        value = compute()
+        if complete:
+            with self._lock:
+                self._entries[key] = value
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return value
+
+
+def aggregate_buckets(store, cache, metric, compute, start, bucket_size):
+    """
+    Run `compute(bucket_start, bucket_end)` for every bucket from `start` on
+
+    Buckets are aligned to multiples of `bucket_size` seconds. Completed
+    buckets that are fully inside the store's retention are served from
+    `cache`. Returns a list of (bucket_start, value) pairs.
+    """
+    latest = store.latest_time
+    earliest = store.earliest_time
+    if latest is None:
+        return []
+    results = []
+    first = max(start, earliest) // bucket_size * bucket_size
+    for bucket_start in range(first, latest + 1, bucket_size):
+        bucket_end = bucket_start + bucket_size
+        complete = bucket_end <= latest and bucket_start >= earliest
+        value = cache.get(
+            (metric, bucket_size, bucket_start),
+            lambda: compute(bucket_start, bucket_end),
+            complete,
+        )
+        results.append((bucket_start, value))
+    return results
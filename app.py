@@ -1,13 +1,36 @@
 import os
+import collections
 import requests
 import json
 import time
 import logging
 import random
 import math
-from flask import Flask, render_template, jsonify, request
+import hmac
+import queue
+import threading
+import uuid
+import zipfile
+from flask import Flask, render_template, jsonify, request, Response
 from datetime import datetime, timedelta
 
+import numpy as np
+
+import alerts
+import analytics
+import fetchplan
+import gtfs
+import headways
+import heatmap
+import profiling
+import raptor
+import snapshots
+import spatial
+import streaming
+import trails
+import wire
+from snapshots import Snapshot, PositionStore
+
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
@@ -23,6 +46,12 @@ API_BASE_URL = "https://api.montevideo.gub.uy/api/transportepublico"
 BUSES_ENDPOINT = 'buses'
 LINES_ENDPOINT = 'buses/linevariants'
 STOPS_ENDPOINT = 'buses/busstops'
+GTFS_ENDPOINT = 'buses/gtfs/static/latest/google_transit.zip'
+
+# Streamed responses are decoded in chunks of this size as they arrive
+STREAM_CHUNK_SIZE = 64 * 1024
+# Seconds to wait for the API to accept a connection or send more data
+UPSTREAM_TIMEOUT = float(os.environ.get("UPSTREAM_TIMEOUT", 10))
 
 # Check if we should use simulation mode
 SIMULATION_MODE = os.environ.get("SIMULATION_MODE", "false").lower() == "true"
@@ -34,6 +63,62 @@ token_data = {
     "expires_at": None
 }
 
+# Full-fleet snapshots are refreshed at most once per interval and recorded
+# for analytics; a day at 15-second resolution (about 160 MB per worker for
+# 1500 buses) is kept by default
+SNAPSHOT_INTERVAL = int(os.environ.get("SNAPSHOT_INTERVAL", 15))
+SNAPSHOT_RETENTION_HOURS = float(os.environ.get("SNAPSHOT_RETENTION_HOURS", 24))
+SNAPSHOT_RECORDER = os.environ.get("SNAPSHOT_RECORDER", "false").lower() == "true"
+TRAIL_MINUTES = int(os.environ.get("TRAIL_MINUTES", 60))
+HEATMAP_WINDOW_MINUTES = int(os.environ.get("HEATMAP_WINDOW_MINUTES", 15))
+
+# Per-stage request timings in the Server-Timing header, and the sampling
+# profiler behind the admin endpoints (disabled when ADMIN_TOKEN is unset)
+profiling.enabled = os.environ.get("SERVER_TIMING", "false").lower() == "true"
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+sampling_profiler = profiling.SamplingProfiler()
+
+# Decides each refresh between one full fetch and concurrent per-line fetches
+fetch_planner = fetchplan.FetchPlanner()
+
+snapshot_data = {
+    "current": None
+}
+snapshot_lock = threading.Lock()
+position_store = PositionStore(retention=int(SNAPSHOT_RETENTION_HOURS * 3600))
+analytics_cache = analytics.BucketCache()
+speed_tracker = headways.LineSpeedTracker()
+wire_encoder = wire.SnapshotEncoder()
+alert_book = alerts.AlertBook()
+# Alert streams are closed and reopened by the client well within the
+# gunicorn worker timeout (30 s by default)
+ALERT_STREAM_SECONDS = int(os.environ.get("ALERT_STREAM_SECONDS", 25))
+ALERT_STREAM_RETRY_MS = 1000
+# Each open stream or waiting poll holds a worker thread; keep some free
+# for everything else (gunicorn runs 8 threads per worker)
+MAX_ALERT_STREAMS = int(os.environ.get("MAX_ALERT_STREAMS", 4))
+ALERT_POLL_SECONDS = 10
+alert_streams = threading.BoundedSemaphore(MAX_ALERT_STREAMS)
+trail_buffer = trails.TrailBuffer(length=max(TRAIL_MINUTES * 60 // SNAPSHOT_INTERVAL, 2))
+heatmap_grid = heatmap.HeatmapGrid(window_seconds=HEATMAP_WINDOW_MINUTES * 60)
+
+# The GTFS static feed for journey planning is loaded on first use and
+# downloaded from the API if it is not on disk; one planner per service date,
+# and the route geometry used to place buses for headways, built with the
+# feed. Fleet refreshes load it in the background, retrying now and then
+GTFS_PATH = os.environ.get("GTFS_PATH", "google_transit.zip")
+# Journeys can be planned for today and the next days; each day's planner
+# takes a few tens of MB, so only the most recently used ones are kept
+PLAN_DAYS = 2
+gtfs_data = {
+    "feed": None,
+    "planners": collections.OrderedDict(),
+    "routes": None,
+    "retry_at": 0
+}
+GTFS_RETRY_SECONDS = 600
+gtfs_lock = threading.Lock()
+
 # Simulated data
 MONTEVIDEO_CENTER = [-34.9011, -56.1645]  # Latitude, Longitude
 SIMULATED_BUS_LINES = ['100', '102', '103', '105', '106', '109', '111', '112', '115', '116', '124', '125', '130', '142', '148', '150', '155', '156', '169', '174', '175', '180', '183', '185', '186', '187', '188', '192', '195', '199']
@@ -74,7 +159,7 @@ def get_access_token():
     
     try:
         logger.debug(f"Making auth request to: {AUTH_URL}")
-        response = requests.post(AUTH_URL, data=data, headers=headers)
+        response = requests.post(AUTH_URL, data=data, headers=headers, timeout=UPSTREAM_TIMEOUT)
         
         # Log response details for debugging
         logger.debug(f"Auth response status: {response.status_code}")
@@ -110,11 +195,30 @@ def get_access_token():
         logger.error(f"Error obtaining access token: {str(e)}")
         return None
 
-def make_api_request(endpoint, params=None):
+def stream_json_array(response, stats=None):
+    """
+    Decode a JSON array response in batches of elements while it downloads
+    """
+    with response:
+        chunks = response.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+        if stats is not None:
+            chunks = fetchplan.count_bytes(chunks, stats)
+        chunks = profiling.timed_iter("upstream", chunks)
+        yield from profiling.timed_iter("decode", streaming.iter_json_batches(chunks))
+
+def make_api_request(endpoint, params=None, stream=False, stats=None):
     """
     Make authenticated request to the Montevideo Transport API
+
+    With stream=True the response should be a JSON array and the data
+    returned is an iterator over lists of its elements, decoded while the
+    body is downloading. Errors are then raised during iteration as
+    json.JSONDecodeError (streaming.NotAnArray for any other JSON value) or
+    requests.exceptions.RequestException. A `stats` dict given with
+    stream=True gets the size of the body added to stats["bytes"].
     """
-    token = get_access_token()
+    with profiling.stage("token"):
+        token = get_access_token()
     if not token:
         return {"error": "Failed to obtain authentication token"}, 500
     
@@ -131,7 +235,8 @@ def make_api_request(endpoint, params=None):
     
     try:
         # Realizar la solicitud GET con los parámetros y headers adecuados
-        response = requests.get(url, headers=headers, params=params)
+        with profiling.stage("upstream"):
+            response = requests.get(url, headers=headers, params=params, stream=stream, timeout=UPSTREAM_TIMEOUT)
         
         # Log de la respuesta para depuración
         logger.debug(f"API response status: {response.status_code}")
@@ -143,9 +248,13 @@ def make_api_request(endpoint, params=None):
             logger.error(f"API error response: {response.text[:500]}...")
             return {"error": f"API Error: {response.status_code}"}, response.status_code
         
+        if stream:
+            return stream_json_array(response, stats), 200
+        
         # Intentar procesar la respuesta como JSON
         try:
-            data = response.json()
+            with profiling.stage("decode"):
+                data = response.json()
             return data, 200
         except json.JSONDecodeError as e:
             logger.error(f"Failed to parse API response as JSON: {str(e)}")
@@ -233,76 +342,238 @@ def generate_simulated_lines():
     """
     return SIMULATED_BUS_LINES
 
+def on_new_snapshot(snapshot):
+    """
+    Run the per-snapshot stages on a freshly fetched fleet snapshot
+    """
+    # Snapshots of a few lines would leave gaps in the recorded history and
+    # understate fleet-wide density, so only whole-fleet ones are recorded
+    if snapshot.fetched_lines is None:
+        position_store.append(snapshot)
+    line_speed = speed_tracker.update(snapshot, len(snapshots.vehicles), len(snapshots.lines))
+    # The derived data travels with the snapshot, so a handler never pairs
+    # one snapshot with data built from another. Headways need the route
+    # geometry, which is loaded with the GTFS feed
+    if gtfs_data["routes"] is None:
+        load_gtfs_in_background()
+    snapshot.headways = headways.HeadwayTable(snapshot, line_speed, gtfs_data["routes"])
+    snapshot.wire = wire_encoder.encode(snapshot)
+    snapshot.index = spatial.SnapshotIndex(snapshot)
+    trail_buffer.append(snapshot)
+    alert_book.evaluate(snapshot)
+    if snapshot.fetched_lines is None:
+        snapshot.heatmap = heatmap_grid.add(snapshot)
+
+def fetch_buses(line=None, stats=None):
+    """
+    Fetch the buses of one line, or of the whole fleet, as BusColumns
+    """
+    params = {'lines': line} if line else None
+    bus_data, status_code = make_api_request(BUSES_ENDPOINT, params=params, stream=True, stats=stats)
+    
+    if status_code != 200:
+        logger.error(f"Failed to get bus data: {bus_data}")
+        return bus_data, status_code
+    
+    try:
+        columns = snapshots.BusColumns()
+        with profiling.stage("normalize"):
+            for batch in bus_data:
+                columns.extend(batch)
+        logger.info(f"Read {len(columns)} buses from API")
+        return columns, 200
+    except (json.JSONDecodeError, requests.exceptions.RequestException) as e:
+        logger.error(f"Failed to decode bus data from API: {str(e)}")
+        return {"error": "Invalid JSON response from API"}, 500
+
+def fetch_fleet_snapshot():
+    """
+    Fetch the buses clients need and turn them into a columnar Snapshot
+    """
+    if SIMULATION_MODE:
+        logger.info("Using simulation mode for bus data")
+        buses = snapshots.BusColumns()
+        buses.extend_formatted(generate_simulated_buses())
+        fetched_lines = None
+    else:
+        # The planner picks one full fetch or concurrent per-line fetches;
+        # lines with arrival alerts are always included
+        fetched, status_code = fetch_planner.fetch(fetch_buses, extra_lines=alert_book.lines())
+        if status_code != 200:
+            return fetched, status_code
+        buses, fetched_lines = fetched["buses"], fetched["lines"]
+    
+    with profiling.stage("snapshot"):
+        snapshot = Snapshot(buses, fetched_lines=fetched_lines)
+        on_new_snapshot(snapshot)
+    return snapshot, 200
+
+def get_fleet_snapshot(lines=None):
+    """
+    Return the current fleet snapshot, refreshing it when it is too old
+
+    Callers that only need some lines pass them in `lines`; a snapshot
+    fetched line by line then serves them. Without `lines` the snapshot
+    must hold the whole fleet. Either way the call counts as demand for
+    the fetch planner.
+    """
+    if lines is None:
+        fetch_planner.watch_fleet()
+    else:
+        fetch_planner.watch(lines)
+    
+    current = snapshot_data["current"]
+    usable = current is not None and current.covers(lines)
+    if usable and time.time() - current.taken_at < SNAPSHOT_INTERVAL:
+        return current, 200
+    
+    # A single caller refreshes at a time. While it waits on the API the
+    # others keep serving the previous snapshot if it holds what they need,
+    # and only wait for the refresh otherwise
+    if not snapshot_lock.acquire(blocking=not usable):
+        return current, 200
+    try:
+        current = snapshot_data["current"]
+        if current and time.time() - current.taken_at < SNAPSHOT_INTERVAL and current.covers(lines):
+            return current, 200
+        
+        snapshot, status_code = fetch_fleet_snapshot()
+        if status_code == 200:
+            snapshot_data["current"] = snapshot
+        return snapshot, status_code
+    finally:
+        snapshot_lock.release()
+
+def run_snapshot_recorder():
+    """Keep refreshing the fleet snapshot so analytics have continuous data"""
+    while True:
+        try:
+            get_fleet_snapshot()
+        except Exception as e:
+            logger.error(f"Snapshot recorder error: {str(e)}")
+        time.sleep(SNAPSHOT_INTERVAL)
+
 @app.route('/api/buses', methods=['GET'])
 def get_buses():
     """Get active buses, optionally filtered by line"""
     line = request.args.get('line')
     
+    if not line:
+        snapshot, status_code = get_fleet_snapshot()
+        if status_code != 200:
+            return jsonify(snapshot), status_code
+        # The dicts are built on first use of each snapshot
+        with profiling.stage("normalize"):
+            buses = snapshot.buses
+        with profiling.stage("jsonify"):
+            response = jsonify(buses)
+        return response, 200
+    
     if SIMULATION_MODE:
         logger.info("Using simulation mode for bus data")
         return jsonify(generate_simulated_buses(line)), 200
     
-    # Otherwise use real API
-    # If a line filter is provided, add it to API request params
-    params = {}
+    # Otherwise serve the line from the shared snapshot, which the fetch
+    # planner may build from per-line requests when few lines are watched
+    logger.info(f"Filtering buses by line: {line}")
+    snapshot, status_code = get_fleet_snapshot(lines=[line])
+    if status_code != 200:
+        return jsonify(snapshot), status_code
+    
+    with profiling.stage("jsonify"):
+        rows = np.flatnonzero(snapshot.line == snapshots.lines.lookup(line))
+        response = jsonify([snapshot.bus(row) for row in rows])
+    return response, 200
+
+@app.route('/api/buses.bin', methods=['GET'])
+def get_buses_binary():
+    """Get all active buses in the compact binary format (see wire.py)"""
+    snapshot, status_code = get_fleet_snapshot()
+    if status_code != 200:
+        return jsonify(snapshot), status_code
+    
+    # The payload is built once per snapshot; every request reuses the same bytes
+    response = Response(snapshot.wire, mimetype='application/octet-stream')
+    response.set_etag(str(snapshot.taken_at))
+    response.headers['Cache-Control'] = f'max-age={SNAPSHOT_INTERVAL}'
+    return response.make_conditional(request)
+
+@app.route('/api/buses/nearest', methods=['GET'])
+def get_nearest_buses():
+    """Get the buses closest to a point, optionally for a single line"""
+    latitude = request.args.get('lat', type=float)
+    longitude = request.args.get('lng', type=float)
+    k = request.args.get('k', default=5, type=int)
+    line = request.args.get('line')
+    
+    if latitude is None or longitude is None:
+        return jsonify({"error": "Parameters lat and lng are required"}), 400
+    k = min(max(k, 1), 50)
+    
+    snapshot, status_code = get_fleet_snapshot(lines=[line] if line else None)
+    if status_code != 200:
+        return jsonify(snapshot), status_code
+    
+    index = snapshot.index
+    line_code = None
     if line:
-        params['lines'] = line
-        logger.info(f"Filtering buses by line: {line}")
+        line_code = snapshots.lines.lookup(line)
     
-    bus_data, status_code = make_api_request('buses', params=params)
+    rows, distances, bearings = index.nearest(latitude, longitude, k, line_code)
     
+    nearest_buses = []
+    for row, distance, bearing in zip(rows, distances, bearings):
+        bus = snapshot.bus(row)
+        bus["distance_m"] = round(float(distance), 1)
+        bus["bearing"] = round(float(bearing), 1)
+        nearest_buses.append(bus)
+    
+    return jsonify(nearest_buses), 200
+
+@app.route('/api/buses/<bus_id>/trail', methods=['GET'])
+def get_bus_trail(bus_id):
+    """Get the recent trajectory of a bus as an encoded polyline"""
+    minutes = request.args.get('minutes', default=10, type=float)
+    minutes = min(max(minutes, 0), TRAIL_MINUTES)
+    
+    # Any fresh snapshot keeps the trails current; no particular lines needed
+    snapshot, status_code = get_fleet_snapshot(lines=())
     if status_code != 200:
-        logger.error(f"Failed to get bus data: {bus_data}")
-        return jsonify(bus_data), status_code
+        return jsonify(snapshot), status_code
     
-    # Log number of buses returned
-    if isinstance(bus_data, list):
-        logger.info(f"Retrieved {len(bus_data)} buses from API")
-        
-        # Transform the API data to match our frontend's expected format
-        formatted_buses = []
-        for bus in bus_data:
-            # Extract lat/lng from the location object if available
-            latitude = None
-            longitude = None
-            
-            if 'location' in bus and 'coordinates' in bus['location'] and len(bus['location']['coordinates']) >= 2:
-                # API returns [longitude, latitude] format, so we need to swap
-                longitude = bus['location']['coordinates'][0]
-                latitude = bus['location']['coordinates'][1]
-            
-            if latitude is None or longitude is None:
-                # Skip buses without valid coordinates
-                continue
-                
-            # Extract heading from the bus data if available
-            heading = 0  # Default heading
-            if 'heading' in bus:
-                heading = bus['heading']
-            elif 'direction' in bus:
-                heading = bus['direction']
-                
-            # Create a formatted bus object
-            formatted_bus = {
-                "id": bus.get('id', f"{bus.get('line', 'unknown')}-{bus.get('busId', 'unknown')}"),
-                "line": bus.get('line', 'unknown'),
-                "order": bus.get('order', 1),  # Default order
-                "latitude": latitude,
-                "longitude": longitude,
-                "heading": heading,
-                "speed": bus.get('speed', 0),
-                "destination": bus.get('destination', bus.get('subline', 'Unknown')),
-                "timestamp": bus.get('timestamp', datetime.now().isoformat()),
-                "company": bus.get('company', ''),
-                "subline": bus.get('subline', '')
-            }
-            
-            formatted_buses.append(formatted_bus)
-            
-        logger.info(f"Formatted {len(formatted_buses)} buses for frontend")
-        return jsonify(formatted_buses), 200
+    vehicle_code = snapshots.vehicles.lookup(bus_id)
+    t, latitude, longitude = trail_buffer.trail(vehicle_code, time.time() - minutes * 60)
+    if not len(t):
+        return jsonify({"error": f"No recent positions for bus {bus_id}"}), 404
+    
+    # Times are encoded like the coordinates: whole seconds since the first point
+    return jsonify({
+        "id": bus_id,
+        "points": len(t),
+        "start": datetime.fromtimestamp(t[0]).isoformat(),
+        "end": datetime.fromtimestamp(t[-1]).isoformat(),
+        "polyline": trails.encode_polyline(latitude, longitude),
+        "times": trails.encode_values((np.round(t - t[0])).astype(np.int64).tolist())
+    }), 200
+
+@app.route('/api/heatmap/<layer>/<int:z>/<int:x>/<int:y>', methods=['GET'])
+def get_heatmap_tile(layer, z, x, y):
+    """Get one heatmap tile of bus density and speed (see heatmap.py)"""
+    snapshot, status_code = get_fleet_snapshot()
+    if status_code != 200:
+        return jsonify(snapshot), status_code
     
-    return jsonify(bus_data), 200
+    tiles = snapshot.heatmap
+    encoded = tiles.tile(layer, z, x, y)
+    if encoded is None:
+        return jsonify({
+            "error": f"Layer must be one of {', '.join(heatmap.LAYERS)} and zoom between {heatmap.MIN_ZOOM} and {heatmap.MAX_ZOOM}"
+        }), 404
+    
+    response = Response(encoded, mimetype='application/json')
+    response.set_etag(f"{tiles.taken_at}-{layer}-{z}-{x}-{y}")
+    response.headers['Cache-Control'] = f'max-age={SNAPSHOT_INTERVAL}'
+    return response.make_conditional(request)
 
 @app.route('/api/lines', methods=['GET'])
 def get_lines():
@@ -331,6 +602,53 @@ def get_lines():
     
     return jsonify(sorted_lines), 200
 
+@app.route('/api/lines/<line>/headways', methods=['GET'])
+def get_line_headways(line):
+    """Headways between consecutive buses of each variant of a line"""
+    snapshot, status_code = get_fleet_snapshot(lines=[line])
+    if status_code != 200:
+        return jsonify(snapshot), status_code
+    
+    table = snapshot.headways
+    if table.geometry is None:
+        return jsonify({"error": "Headways need the GTFS route geometry, which is not loaded yet"}), 503
+    line_code = snapshots.lines.lookup(line)
+    if line_code < 0:
+        return jsonify({"error": f"No buses recorded for line {line}"}), 404
+    
+    variants = []
+    for group in table.groups_for_line(line_code):
+        buses = []
+        # Buses are ordered along the route, from the back to the front
+        for i in range(table.group_start[group], table.group_start[group + 1]):
+            bus = snapshot.bus(table.order[i])
+            headway = table.headway[i]
+            buses.append({
+                "id": bus["id"],
+                "latitude": bus["latitude"],
+                "longitude": bus["longitude"],
+                "destination": bus["destination"],
+                "progress_m": None if math.isnan(table.progress[i]) else round(float(table.progress[i]), 1),
+                "spacing_m": None if math.isnan(headway) else round(float(table.spacing[i]), 1),
+                "headway_s": None if math.isnan(headway) else round(float(headway)),
+                "status": headways.STATUS_NAMES[table.status[i]]
+            })
+        
+        mean_headway = table.mean_headway[group]
+        variants.append({
+            "subline": snapshots.sublines.values[table.group_subline[group]],
+            "mean_headway_s": None if math.isnan(mean_headway) else round(float(mean_headway)),
+            "bunched": sum(1 for bus in buses if bus["status"] == "bunched"),
+            "gaps": sum(1 for bus in buses if bus["status"] == "gap"),
+            "buses": buses
+        })
+    
+    return jsonify({
+        "line": line,
+        "timestamp": datetime.fromtimestamp(snapshot.taken_at).isoformat(),
+        "variants": variants
+    }), 200
+
 # Simulate bus stops for when the API is not available
 def generate_simulated_stops(latitude=None, longitude=None, radius=None):
     """Generate simulated bus stops for a given area"""
@@ -372,6 +690,41 @@ def generate_simulated_stops(latitude=None, longitude=None, radius=None):
     
     return stops
 
+def format_stops(stops_data):
+    """
+    Format the stops data for the frontend
+    """
+    formatted_stops = []
+    for stop in stops_data:
+        # Extract location data
+        latitude = None
+        longitude = None
+        
+        if 'location' in stop and 'coordinates' in stop['location'] and len(stop['location']['coordinates']) >= 2:
+            # API returns [longitude, latitude] format, so we need to swap
+            longitude = stop['location']['coordinates'][0]
+            latitude = stop['location']['coordinates'][1]
+        
+        if latitude is None or longitude is None:
+            # Skip stops without valid coordinates
+            continue
+            
+        # Create a formatted stop object
+        formatted_stop = {
+            "id": stop.get('id', ''),
+            "code": stop.get('code', ''),
+            "name": stop.get('nombre', stop.get('name', '')),
+            "address": stop.get('direccion', stop.get('address', '')),
+            "latitude": latitude,
+            "longitude": longitude,
+            "lines": stop.get('lines', [])
+        }
+        
+        formatted_stops.append(formatted_stop)
+        
+    logger.info(f"Formatted {len(formatted_stops)} stops for frontend")
+    return formatted_stops
+
 @app.route('/api/stops', methods=['GET'])
 def get_stops():
     """Get bus stops, optionally filtered by location and radius"""
@@ -393,48 +746,458 @@ def get_stops():
         params['radius'] = radius
         logger.info(f"Querying stops near ({latitude}, {longitude}) with radius {radius}m")
     
-    stops_data, status_code = make_api_request(STOPS_ENDPOINT, params=params)
+    stops_data, status_code = make_api_request(STOPS_ENDPOINT, params=params, stream=True)
     
     if status_code != 200:
         logger.error(f"Failed to get stops data: {stops_data}")
         return jsonify(stops_data), status_code
     
-    # Format the stops data for the frontend
-    if isinstance(stops_data, list):
-        logger.info(f"Retrieved {len(stops_data)} stops from API")
+    try:
+        return jsonify(format_stops(stop for batch in stops_data for stop in batch)), 200
+    except streaming.NotAnArray as e:
+        # Anything but a list of stops is passed through as the API sent it
+        return jsonify(e.value), 200
+    except (json.JSONDecodeError, requests.exceptions.RequestException) as e:
+        logger.error(f"Failed to decode stops data from API: {str(e)}")
+        return jsonify({"error": "Invalid JSON response from API"}), 500
+
+# Arrival alerts
+@app.route('/api/alerts/subscriptions', methods=['POST'])
+def create_alert_subscription():
+    """Register an alert: a bus of `line` within `radius` meters of a point"""
+    data = request.get_json(silent=True) or {}
+    line = data.get('line')
+    latitude = data.get('lat')
+    longitude = data.get('lng')
+    stop = data.get('stop')
+    
+    if stop is not None:
+        # A stop id takes its coordinates from the GTFS feed
+        stop = str(stop)
+        feed, status_code = get_gtfs_feed()
+        if status_code != 200:
+            return jsonify(feed), status_code
+        index = feed.stop_index.get(stop)
+        if index is None:
+            return jsonify({"error": f"Unknown stop {stop}"}), 404
+        latitude = float(feed.stop_latitude[index])
+        longitude = float(feed.stop_longitude[index])
+    
+    if not line or latitude is None or longitude is None:
+        return jsonify({"error": "Fields line and stop, or line, lat and lng, are required"}), 400
+    try:
+        latitude, longitude = float(latitude), float(longitude)
+        radius = float(data.get('radius', 500))
+    except (TypeError, ValueError):
+        return jsonify({"error": "Fields lat, lng and radius must be numbers"}), 400
+    # Only lines seen in the fleet or listed in the GTFS feed are accepted
+    line = str(line)
+    routes = gtfs_data["routes"]
+    if snapshots.lines.lookup(line) < 0 and (routes is None or line not in routes.line_segments):
+        return jsonify({"error": f"Unknown line {line}"}), 400
+    
+    # New clients get an id to open the event stream with
+    client = data.get('client') or uuid.uuid4().hex
+    subscription = alert_book.subscribe(client, line, latitude, longitude, radius, stop=stop)
+    logger.info(f"New alert subscription {subscription['id']} for line {line}")
+    return jsonify(subscription), 201
+
+@app.route('/api/alerts/subscriptions', methods=['GET'])
+def get_alert_subscriptions():
+    """List the alert subscriptions of a client"""
+    client = request.args.get('client')
+    if not client:
+        return jsonify({"error": "Parameter client is required"}), 400
+    return jsonify(alert_book.subscriptions(client)), 200
+
+@app.route('/api/alerts/subscriptions/<int:subscription_id>', methods=['DELETE'])
+def delete_alert_subscription(subscription_id):
+    """Remove one of a client's alert subscriptions"""
+    client = request.args.get('client')
+    if not alert_book.unsubscribe(client, subscription_id):
+        return jsonify({"error": "Subscription not found"}), 404
+    return '', 204
+
+@app.route('/api/alerts/stream', methods=['GET'])
+def stream_alerts():
+    """Push a client's alert events as Server-Sent Events"""
+    client = request.args.get('client')
+    events = alert_book.events(client)
+    if events is None:
+        return jsonify({"error": "Unknown client, create a subscription first"}), 404
+    if not alert_streams.acquire(blocking=False):
+        response = jsonify({"error": "Too many open alert streams, use /api/alerts/events"})
+        response.headers['Retry-After'] = str(ALERT_STREAM_SECONDS)
+        return response, 503
+    
+    def generate():
+        # Streams end before the worker timeout; the browser's EventSource
+        # reconnects after the retry delay and resumes from the same queue
+        yield f"retry: {ALERT_STREAM_RETRY_MS}\n\n"
+        deadline = time.monotonic() + ALERT_STREAM_SECONDS
+        while True:
+            remaining = deadline - time.monotonic()
+            # Stop once the client's subscriptions expired and its queue was dropped
+            if remaining <= 0 or alert_book.events(client) is not events:
+                return
+            try:
+                event = events.get(timeout=min(SNAPSHOT_INTERVAL, remaining))
+                yield f"event: arrival\ndata: {json.dumps(event)}\n\n"
+            except queue.Empty:
+                # Listening clients keep the fleet refreshing, which evaluates the alerts
+                get_fleet_snapshot(lines=alert_book.lines())
+                yield ": keepalive\n\n"
+    
+    response = Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    # Runs however the stream ends, even if it never started
+    response.call_on_close(alert_streams.release)
+    return response
+
+@app.route('/api/alerts/events', methods=['GET'])
+def poll_alerts():
+    """Return a client's queued alert events, waiting briefly if there are none"""
+    client = request.args.get('client')
+    events = alert_book.events(client)
+    if events is None:
+        return jsonify({"error": "Unknown client, create a subscription first"}), 404
+    wait = request.args.get('wait', default=ALERT_POLL_SECONDS, type=float)
+    wait = min(max(wait, 0), ALERT_POLL_SECONDS)
+    
+    # Listening clients keep the fleet refreshing, which evaluates the alerts
+    get_fleet_snapshot(lines=alert_book.lines())
+    pending = []
+    while not events.empty():
+        pending.append(events.get_nowait())
+    
+    # Waiting takes a stream slot; without one the poll answers right away
+    if not pending and wait > 0 and alert_streams.acquire(blocking=False):
+        try:
+            pending.append(events.get(timeout=wait))
+        except queue.Empty:
+            pass
+        finally:
+            alert_streams.release()
+    return jsonify(pending), 200
+
+# Journey planning over the GTFS static feed
+def download_gtfs_feed():
+    """
+    Download the GTFS static feed from the API to GTFS_PATH
+    """
+    token = get_access_token()
+    if not token:
+        return False
+    
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "User-Agent": "BusTrackerApp/1.0"
+    }
+    url = f"{API_BASE_URL}/{GTFS_ENDPOINT}"
+    logger.info(f"Downloading GTFS feed from: {url}")
+    
+    try:
+        response = requests.get(url, headers=headers, stream=True, timeout=UPSTREAM_TIMEOUT)
+        if response.status_code != 200:
+            logger.error(f"GTFS download failed with status code: {response.status_code}")
+            return False
+        partial = f"{GTFS_PATH}.part"
+        with response, open(partial, "wb") as output:
+            for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                output.write(chunk)
+        os.replace(partial, GTFS_PATH)
+        return True
+    except (requests.exceptions.RequestException, OSError) as e:
+        logger.error(f"Error downloading GTFS feed: {str(e)}")
+        return False
+
+def get_gtfs_feed():
+    """
+    Return the GTFS feed, loading it (and downloading it if needed) on first use
+    """
+    with gtfs_lock:
+        if gtfs_data["feed"] is not None:
+            return gtfs_data["feed"], 200
         
-        formatted_stops = []
-        for stop in stops_data:
-            # Extract location data
-            latitude = None
-            longitude = None
-            
-            if 'location' in stop and 'coordinates' in stop['location'] and len(stop['location']['coordinates']) >= 2:
-                # API returns [longitude, latitude] format, so we need to swap
-                longitude = stop['location']['coordinates'][0]
-                latitude = stop['location']['coordinates'][1]
-            
-            if latitude is None or longitude is None:
-                # Skip stops without valid coordinates
-                continue
-                
-            # Create a formatted stop object
-            formatted_stop = {
-                "id": stop.get('id', ''),
-                "code": stop.get('code', ''),
-                "name": stop.get('nombre', stop.get('name', '')),
-                "address": stop.get('direccion', stop.get('address', '')),
-                "latitude": latitude,
-                "longitude": longitude,
-                "lines": stop.get('lines', [])
+        if SIMULATION_MODE and not os.path.exists(GTFS_PATH):
+            return {"error": "Journey planning needs a GTFS feed (set GTFS_PATH)"}, 503
+        if not os.path.exists(GTFS_PATH) and not download_gtfs_feed():
+            return {"error": "GTFS feed is not available"}, 503
+        try:
+            feed = gtfs.Feed(GTFS_PATH)
+            gtfs_data["routes"] = headways.RouteGeometry(feed)
+        except (OSError, ValueError, KeyError, IndexError, zipfile.BadZipFile) as e:
+            logger.error(f"Failed to load GTFS feed: {str(e)}")
+            return {"error": "GTFS feed could not be loaded"}, 503
+        gtfs_data["feed"] = feed
+        return feed, 200
+
+def load_gtfs_in_background():
+    """
+    Start loading the GTFS feed on its own thread, unless it is loaded or a
+    recent attempt is still in progress or failed
+    """
+    # Called from the refresh, which runs one at a time; gtfs_lock would
+    # make it wait for a load in progress
+    if gtfs_data["feed"] is not None or time.time() < gtfs_data["retry_at"]:
+        return
+    gtfs_data["retry_at"] = time.time() + GTFS_RETRY_SECONDS
+    threading.Thread(target=get_gtfs_feed, daemon=True).start()
+
+def get_planner(day):
+    """
+    Return the journey planner for a service date, loading the feed if needed
+    """
+    feed, status_code = get_gtfs_feed()
+    if status_code != 200:
+        return feed, status_code
+    
+    with gtfs_lock:
+        planners = gtfs_data["planners"]
+        planner = planners.get(day)
+        if planner:
+            planners.move_to_end(day)
+            return planner, 200
+        
+        try:
+            planner = raptor.Planner(gtfs.Timetable(feed, day))
+        except (ValueError, KeyError, IndexError) as e:
+            logger.error(f"Failed to build the timetable for {day}: {str(e)}")
+            return {"error": f"No timetable could be built for {day}"}, 503
+        
+        planners[day] = planner
+        while len(planners) > PLAN_DAYS:
+            planners.popitem(last=False)
+        return planner, 200
+
+def parse_coordinates(value):
+    """Parse a "lat,lng" query parameter; returns None if malformed"""
+    try:
+        latitude, longitude = (float(part) for part in value.split(','))
+    except (AttributeError, ValueError):
+        return None
+    return latitude, longitude
+
+@app.route('/api/plan', methods=['GET'])
+def plan_journey():
+    """Plan bus journeys between two points with RAPTOR over the GTFS feed"""
+    origin = parse_coordinates(request.args.get('from'))
+    destination = parse_coordinates(request.args.get('to'))
+    depart = request.args.get('depart')
+    
+    if origin is None or destination is None:
+        return jsonify({"error": "Parameters from and to are required as lat,lng"}), 400
+    
+    # Departure as HH:MM (today) or an ISO date and time; defaults to now
+    now = datetime.now()
+    try:
+        if not depart:
+            departure = now
+        elif 'T' in depart or '-' in depart:
+            departure = datetime.fromisoformat(depart)
+        else:
+            departure = datetime.combine(now.date(), datetime.strptime(depart, '%H:%M').time())
+    except ValueError:
+        return jsonify({"error": "Parameter depart must be HH:MM or an ISO date and time"}), 400
+    if not 0 <= (departure.date() - now.date()).days < PLAN_DAYS:
+        return jsonify({"error": f"Parameter depart must be within the next {PLAN_DAYS} days"}), 400
+    
+    planner, status_code = get_planner(departure.date())
+    if status_code != 200:
+        return jsonify(planner), status_code
+    
+    seconds = departure.hour * 3600 + departure.minute * 60 + departure.second
+    started = time.perf_counter()
+    journeys = planner.plan(origin, destination, seconds)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    logger.debug(f"Planned {len(journeys)} journeys in {elapsed_ms:.1f} ms")
+    
+    return jsonify({
+        "date": departure.date().isoformat(),
+        "departure": departure.strftime('%H:%M:%S'),
+        "journeys": journeys,
+        "elapsed_ms": round(elapsed_ms, 1)
+    }), 200
+
+# Request profiling and admin endpoints
+@app.before_request
+def start_stage_timings():
+    profiling.begin()
+
+@app.after_request
+def add_server_timing(response):
+    server_timing = profiling.finish()
+    if server_timing:
+        response.headers['Server-Timing'] = server_timing
+    return response
+
+def check_admin_token():
+    """
+    Return an error response unless the request carries the admin token
+    """
+    if not ADMIN_TOKEN:
+        return jsonify({"error": "Admin endpoints are disabled (set ADMIN_TOKEN)"}), 403
+    
+    supplied = request.headers.get('X-Admin-Token', '')
+    authorization = request.headers.get('Authorization', '')
+    if authorization.startswith('Bearer '):
+        supplied = authorization[len('Bearer '):]
+    if not hmac.compare_digest(supplied.encode(), ADMIN_TOKEN.encode()):
+        return jsonify({"error": "Invalid admin token"}), 403
+    return None
+
+@app.route('/api/admin/profile', methods=['POST'])
+def start_profile():
+    """Start the sampling profiler for ?seconds= (admin only)"""
+    error = check_admin_token()
+    if error:
+        return error
+    
+    seconds = request.args.get('seconds', default=30, type=int)
+    if not sampling_profiler.start(seconds):
+        return jsonify({"error": "The profiler is already running", **sampling_profiler.status()}), 409
+    logger.info(f"Sampling profiler started for {seconds} seconds")
+    return jsonify(sampling_profiler.status()), 202
+
+@app.route('/api/admin/profile', methods=['DELETE'])
+def stop_profile():
+    """Stop the sampling profiler early (admin only)"""
+    error = check_admin_token()
+    if error:
+        return error
+    
+    sampling_profiler.stop()
+    return jsonify(sampling_profiler.status()), 200
+
+@app.route('/api/admin/profile', methods=['GET'])
+def get_profile():
+    """Get the latest profile as collapsed stacks for flamegraphs (admin only)"""
+    error = check_admin_token()
+    if error:
+        return error
+    
+    response = Response(sampling_profiler.collapsed(), mimetype='text/plain')
+    response.headers['X-Profile-Samples'] = str(sampling_profiler.samples)
+    response.headers['X-Profile-Running'] = str(sampling_profiler.running).lower()
+    return response
+
+@app.route('/api/admin/fetch-plan', methods=['GET'])
+def get_fetch_plan():
+    """Get the fetch planner's demand, measured costs and last decision (admin only)"""
+    error = check_admin_token()
+    if error:
+        return error
+    return jsonify(fetch_planner.status()), 200
+
+# Analytics over recorded snapshots
+def analytics_window_args():
+    """
+    Parse the common analytics query parameters
+
+    Returns (start, bucket_size, line_code) where line_code is None when no
+    line filter was given and -1 when the line was never recorded.
+    """
+    hours = request.args.get('hours', default=24, type=float)
+    bucket_size = request.args.get('bucket', default=3600, type=int)
+    line = request.args.get('line')
+    
+    hours = min(max(hours, 0), SNAPSHOT_RETENTION_HOURS)
+    bucket_size = max(bucket_size, SNAPSHOT_INTERVAL, 60)
+    start = int(time.time() - hours * 3600)
+    line_code = snapshots.lines.lookup(line) if line else None
+    return start, bucket_size, line_code
+
+def bucket_rows(buckets, line_code, make_row):
+    """Flatten per-bucket arrays indexed by line code into JSON rows"""
+    rows = []
+    for bucket_start, arrays in buckets:
+        codes = np.flatnonzero(arrays[-1])
+        if line_code is not None:
+            codes = codes[codes == line_code]
+        for code in codes:
+            row = {
+                "line": snapshots.lines.values[code],
+                "bucket_start": datetime.fromtimestamp(bucket_start).isoformat()
             }
-            
-            formatted_stops.append(formatted_stop)
-            
-        logger.info(f"Formatted {len(formatted_stops)} stops for frontend")
-        return jsonify(formatted_stops), 200
+            row.update(make_row(*(array[code] for array in arrays)))
+            rows.append(row)
+    return rows
+
+@app.route('/api/analytics/speed', methods=['GET'])
+def get_speed_analytics():
+    """Average commercial speed per line and time bucket"""
+    get_fleet_snapshot()
+    start, bucket_size, line_code = analytics_window_args()
+    
+    def compute(bucket_start, bucket_end):
+        window = position_store.window(bucket_start - analytics.MAX_SPEED_GAP_S, bucket_end)
+        return analytics.commercial_speed(window, len(snapshots.lines), since=bucket_start)
     
-    return jsonify(stops_data), 200
+    buckets = analytics.aggregate_buckets(position_store, analytics_cache, 'speed', compute, start, bucket_size)
+    rows = bucket_rows(buckets, line_code, lambda distance_m, elapsed_s: {
+        "speed_kmh": round(distance_m / elapsed_s * 3.6, 2),
+        "distance_km": round(distance_m / 1000, 3),
+        "vehicle_hours": round(elapsed_s / 3600, 3)
+    })
+    return jsonify(rows), 200
+
+@app.route('/api/analytics/bunching', methods=['GET'])
+def get_bunching_analytics():
+    """Share of bus observations that were bunched, per line and time bucket"""
+    get_fleet_snapshot()
+    start, bucket_size, line_code = analytics_window_args()
+    
+    def compute(bucket_start, bucket_end):
+        window = position_store.window(bucket_start, bucket_end)
+        return analytics.bunching(window, len(snapshots.lines))
+    
+    buckets = analytics.aggregate_buckets(position_store, analytics_cache, 'bunching', compute, start, bucket_size)
+    rows = bucket_rows(buckets, line_code, lambda bunched, observed: {
+        "bunched": int(bunched),
+        "observed": int(observed),
+        "frequency": round(bunched / observed, 4)
+    })
+    return jsonify(rows), 200
+
+@app.route('/api/analytics/silent', methods=['GET'])
+def get_silent_buses():
+    """Buses seen recently that stopped reporting"""
+    get_fleet_snapshot()
+    minutes = request.args.get('minutes', default=5, type=float)
+    hours = request.args.get('hours', default=2, type=float)
+    line = request.args.get('line')
+    
+    latest = position_store.latest_time
+    if latest is None:
+        return jsonify([]), 200
+    
+    def compute():
+        window = position_store.window(latest - hours * 3600)
+        codes, rows = analytics.last_seen(window)
+        silent = window["t"][rows] < latest - minutes * 60
+        return codes[silent], {name: column[rows[silent]] for name, column in window.items()}
+    
+    # Keyed by the latest snapshot, so it is recomputed once per refresh
+    codes, last = analytics_cache.get(('silent', latest, minutes, hours), compute, True)
+    
+    silent_buses = []
+    for i, code in enumerate(codes):
+        bus_line = snapshots.lines.values[last["line"][i]]
+        if line and bus_line != line:
+            continue
+        silent_buses.append({
+            "id": snapshots.vehicles.values[code],
+            "line": bus_line,
+            "latitude": float(last["latitude"][i]),
+            "longitude": float(last["longitude"][i]),
+            "last_seen": datetime.fromtimestamp(int(last["t"][i])).isoformat(),
+            "silent_minutes": round((latest - int(last["t"][i])) / 60, 1)
+        })
+    
+    return jsonify(silent_buses), 200
+
+if SNAPSHOT_RECORDER:
+    logger.info("Starting background snapshot recorder")
+    threading.Thread(target=run_snapshot_recorder, daemon=True).start()
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
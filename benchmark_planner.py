@@ -0,0 +1,83 @@
+"""
+Benchmark the journey planner on fixed origin/destination pairs
+
+Usage: python benchmark_planner.py [--feed google_transit.zip] [--date YYYY-MM-DD]
+                                   [--depart HH:MM] [--repeat N]
+
+Loads the GTFS feed, builds the timetable for the date and runs every pair
+below, printing the journeys found and the query latency.
+"""
+import argparse
+import statistics
+import time
+from datetime import date, datetime
+
+import gtfs
+import raptor
+
+PLACES = {
+    "Ciudad Vieja": (-34.9068, -56.2104),
+    "Pocitos": (-34.9100, -56.1500),
+    "Tres Cruces": (-34.8940, -56.1660),
+    "Carrasco": (-34.8840, -56.0550),
+    "Cerro": (-34.8870, -56.2560),
+    "Malvín": (-34.8930, -56.1020),
+    "Unión": (-34.8730, -56.1410),
+    "Prado": (-34.8590, -56.2030),
+    "Punta Carretas": (-34.9230, -56.1590),
+    "Colón": (-34.8030, -56.2230),
+}
+
+PAIRS = [
+    ("Ciudad Vieja", "Carrasco"),
+    ("Cerro", "Pocitos"),
+    ("Tres Cruces", "Ciudad Vieja"),
+    ("Colón", "Punta Carretas"),
+    ("Prado", "Malvín"),
+    ("Unión", "Cerro"),
+    ("Pocitos", "Colón"),
+    ("Carrasco", "Prado"),
+    ("Punta Carretas", "Unión"),
+    ("Malvín", "Tres Cruces"),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--feed", default="google_transit.zip")
+    parser.add_argument("--date", default=date.today().isoformat())
+    parser.add_argument("--depart", default="08:00")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    feed = gtfs.Feed(args.feed)
+    loaded = time.perf_counter()
+    planner = raptor.Planner(gtfs.Timetable(feed, date.fromisoformat(args.date)))
+    built = time.perf_counter()
+    print(f"Feed loaded in {loaded - started:.2f} s, timetable built in {built - loaded:.2f} s")
+
+    depart = datetime.strptime(args.depart, "%H:%M")
+    departure = depart.hour * 3600 + depart.minute * 60
+    latencies = []
+    for origin, destination in PAIRS:
+        pair_latencies = []
+        for _ in range(args.repeat):
+            query_started = time.perf_counter()
+            journeys = planner.plan(PLACES[origin], PLACES[destination], departure)
+            pair_latencies.append((time.perf_counter() - query_started) * 1000)
+        latencies.extend(pair_latencies)
+        summary = ", ".join(
+            f"{journey['arrival']} ({journey['transfers']} transfers)" for journey in journeys
+        ) or "no journey"
+        print(f"{origin} -> {destination}: {statistics.median(pair_latencies):.1f} ms; {summary}")
+
+    latencies.sort()
+    print(
+        f"{len(latencies)} queries: median {statistics.median(latencies):.1f} ms, "
+        f"p95 {latencies[int(len(latencies) * 0.95) - 1]:.1f} ms, max {latencies[-1]:.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""
+Demand-driven planning of upstream bus fetches
+
+The API serves the whole fleet from /buses, or only some lines through its
+`lines` parameter. FetchPlanner remembers what clients asked for recently:
+the whole fleet (map overview, analytics, heatmaps) or specific lines (a
+filtered map, a line's headways, arrival alerts). Each refresh it picks the
+cheaper way to cover that demand:
+
+- one full /buses fetch, or
+- one request per watched line, run concurrently and merged into a single
+  snapshot stamped with one time.
+
+The choice uses measured costs: smoothed payload sizes and latencies of
+full fetches and of per-line fetches. Lines not fetched line by line yet
+are estimated from their share of buses in the last full fetch. Per-line
+fetching is chosen only when it downloads fewer bytes without being much
+slower, and a full fetch is repeated now and then to keep the baseline
+current.
+"""
+import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import profiling
+import snapshots
+
+logger = logging.getLogger(__name__)
+
+# Clients that stopped asking for a while no longer count as demand
+DEMAND_TTL_S = 120
+FETCH_CONCURRENCY = 8
+MAX_LINE_FETCHES = 24
+# Per-line fetching may take at most this much longer than a full fetch
+LATENCY_TOLERANCE = 1.5
+# Headers and framing of one extra HTTP exchange
+REQUEST_OVERHEAD_BYTES = 1000
+# Redo a full fetch at least this often to refresh the baseline
+PROBE_INTERVAL_S = 900
+# Weight of the newest measurement in the smoothed costs
+SMOOTHING = 0.3
+
+
+def smooth(previous, value):
+    return value if previous is None else previous + SMOOTHING * (value - previous)
+
+
+def count_bytes(chunks, stats):
+    """Pass chunks through, adding their size to stats["bytes"]"""
+    for chunk in chunks:
+        stats["bytes"] += len(chunk)
+        yield chunk
+
+
+class FetchPlanner:
+    """
+    Tracks demand and measured costs, and runs the cheaper fetch
+    """
+
+    def __init__(self, concurrency=FETCH_CONCURRENCY):
+        self.concurrency = concurrency
+        self.full_bytes = None
+        self.full_latency = None
+        self.full_at = None
+        self.line_bytes = {}
+        self.line_latency = None
+        self.line_buses = {}
+        self.last_plan = None
+        self._fleet_watched_at = None
+        self._lines_watched_at = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="line-fetch")
+
+    def watch_fleet(self):
+        """Record that a client needs the whole fleet"""
+        self._fleet_watched_at = time.time()
+
+    def watch(self, lines):
+        """Record that a client needs these lines"""
+        now = time.time()
+        with self._lock:
+            for line in lines:
+                self._lines_watched_at[str(line)] = now
+
+    def demand(self):
+        """Return (whole fleet needed, sorted watched lines)"""
+        now = time.time()
+        with self._lock:
+            for line in [l for l, at in self._lines_watched_at.items() if at < now - DEMAND_TTL_S]:
+                del self._lines_watched_at[line]
+            lines = sorted(self._lines_watched_at)
+        fleet = self._fleet_watched_at is not None and self._fleet_watched_at >= now - DEMAND_TTL_S
+        return fleet, lines
+
+    def plan(self, extra_lines=()):
+        """
+        Decide how to fetch: None for the whole fleet, or a list of lines
+
+        `extra_lines` are needed regardless of client requests, e.g. lines
+        with arrival alerts.
+        """
+        fleet, lines = self.demand()
+        lines = sorted(set(lines) | {str(line) for line in extra_lines})
+        plan = {"mode": "full", "lines": lines, "reason": None}
+
+        if fleet:
+            plan["reason"] = "whole fleet requested"
+        elif not lines:
+            plan["reason"] = "no line demand"
+        elif self.full_at is None or time.time() - self.full_at > PROBE_INTERVAL_S:
+            plan["reason"] = "refreshing the full fetch baseline"
+        elif len(lines) > MAX_LINE_FETCHES:
+            plan["reason"] = "too many lines"
+        else:
+            line_bytes = sum(self.estimate_line_bytes(line) for line in lines)
+            line_latency = math.ceil(len(lines) / self.concurrency) * (self.line_latency or self.full_latency)
+            plan.update({
+                "full_bytes": round(self.full_bytes),
+                "full_latency_s": round(self.full_latency, 3),
+                "lines_bytes": round(line_bytes),
+                "lines_latency_s": round(line_latency, 3)
+            })
+            if line_bytes >= self.full_bytes:
+                plan["reason"] = "per-line fetches would download more"
+            elif line_latency > self.full_latency * LATENCY_TOLERANCE:
+                plan["reason"] = "per-line fetches would be too slow"
+            else:
+                plan["mode"] = "lines"
+                plan["reason"] = "per-line fetches are cheaper"
+
+        self.last_plan = plan
+        return lines if plan["mode"] == "lines" else None
+
+    def estimate_line_bytes(self, line):
+        """Expected payload of one per-line fetch, with request overhead"""
+        measured = self.line_bytes.get(line)
+        if measured is None:
+            total_buses = max(sum(self.line_buses.values()), 1)
+            measured = self.full_bytes * max(self.line_buses.get(line, 0), 1) / total_buses
+        return measured + REQUEST_OVERHEAD_BYTES
+
+    def fetch(self, fetch_buses, extra_lines=()):
+        """
+        Fetch the buses needed right now
+
+        `fetch_buses(line, stats)` fetches one line, or the whole fleet for
+        line None, returning (BusColumns, status_code) and adding the
+        payload size to stats["bytes"]. Returns ({"buses": BusColumns,
+        "lines": lines}, 200), where lines is None when the whole fleet was
+        fetched, or an error dict and status code.
+        """
+        lines = self.plan(extra_lines)
+        if lines is not None:
+            buses = self._fetch_lines(fetch_buses, lines)
+            if buses is not None:
+                return {"buses": buses, "lines": frozenset(lines)}, 200
+            logger.warning("Per-line fetch failed, falling back to a full fetch")
+
+        buses, status_code, stats, latency = self._measure(fetch_buses, None)
+        if status_code != 200:
+            return buses, status_code
+        self.full_bytes = smooth(self.full_bytes, stats["bytes"])
+        self.full_latency = smooth(self.full_latency, latency)
+        self.full_at = time.time()
+        self.line_buses = buses.line_counts()
+        return {"buses": buses, "lines": None}, 200
+
+    def _fetch_lines(self, fetch_buses, lines):
+        started = time.perf_counter()
+        # Stages timed on the worker threads still show up in the request
+        measure = profiling.propagate(self._measure)
+        futures = [self._executor.submit(measure, fetch_buses, line) for line in lines]
+        results = [future.result() for future in futures]
+        if any(status_code != 200 for _, status_code, _, _ in results):
+            return None
+
+        for line, (_, _, stats, latency) in zip(lines, results):
+            self.line_bytes[line] = smooth(self.line_bytes.get(line), stats["bytes"])
+            self.line_latency = smooth(self.line_latency, latency)
+        self.last_plan["elapsed_s"] = round(time.perf_counter() - started, 3)
+        # One snapshot: every line from this round, each bus once
+        return snapshots.BusColumns.merge([buses for buses, _, _, _ in results])
+
+    def _measure(self, fetch_buses, line):
+        stats = {"bytes": 0}
+        started = time.perf_counter()
+        buses, status_code = fetch_buses(line, stats)
+        return buses, status_code, stats, time.perf_counter() - started
+
+    def status(self):
+        fleet, lines = self.demand()
+        return {
+            "fleet_demand": fleet,
+            "line_demand": lines,
+            "full_bytes": self.full_bytes,
+            "full_latency_s": self.full_latency,
+            "line_latency_s": self.line_latency,
+            "line_bytes": self.line_bytes,
+            "last_plan": self.last_plan
+        }
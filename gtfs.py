@@ -0,0 +1,318 @@
+"""
+GTFS static feed and array-backed timetables
+
+Feed reads the GTFS zip published by the Montevideo API (stops, routes,
+trips, stop_times and the service calendar) into NumPy arrays, and
+precomputes the walking transfers between nearby stops with the stop
+spatial index.
+
+Timetable lays out the trips running on one service date the way the RAPTOR
+engine in raptor.py scans them. Trips with the same stop sequence and no
+overtaking form a pattern. Every stop of every pattern is a "position", and
+the departures and arrivals of all trips of the pattern at a position are
+stored contiguously in one column, sorted by time. Columns are keyed by
+position * TIME_SPAN + time, so a single searchsorted finds the first
+catchable trip at every position at once.
+"""
+import csv
+import io
+import itertools
+import logging
+import zipfile
+from operator import itemgetter
+
+import numpy as np
+
+import spatial
+from analytics import METERS_PER_DEGREE
+
+logger = logging.getLogger(__name__)
+
+# Walking between stops, and to and from them
+MAX_TRANSFER_WALK_M = 400
+WALK_SPEED_MS = 1.2
+WALK_DETOUR = 1.3  # Street distance over straight-line distance
+REFERENCE_LATITUDE = -34.9  # Montevideo
+
+# Service times are below 48 h, so they fit under this in the column keys
+TIME_SPAN = 1 << 20
+CHUNK_ROWS = 100000
+
+_time_cache = {}
+
+WEEKDAYS = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+
+
+def project(latitude, longitude):
+    x = np.asarray(longitude, dtype=np.float64) * METERS_PER_DEGREE * np.cos(np.radians(REFERENCE_LATITUDE))
+    y = np.asarray(latitude, dtype=np.float64) * METERS_PER_DEGREE
+    return x, y
+
+
+def walk_seconds(distance_m):
+    return np.ceil(np.asarray(distance_m) * WALK_DETOUR / WALK_SPEED_MS).astype(np.int64)
+
+
+def parse_time(value):
+    """Seconds after midnight of a GTFS time (may exceed 24:00), -1 if empty"""
+    seconds = _time_cache.get(value)
+    if seconds is None:
+        if value.strip():
+            hours, minutes, secs = value.strip().split(":")
+            seconds = int(hours) * 3600 + int(minutes) * 60 + int(secs)
+        else:
+            seconds = -1
+        _time_cache[value] = seconds
+    return seconds
+
+
+def iter_columns(archive, name, columns, required=True):
+    """
+    Read selected columns of a GTFS file in chunks of rows
+
+    Yields one tuple of column value lists per chunk, so large files such
+    as stop_times.txt never hold all their rows as Python lists.
+    """
+    if name not in archive.namelist():
+        if required:
+            raise ValueError(f"GTFS feed has no {name}")
+        return
+    with archive.open(name) as raw:
+        reader = csv.reader(io.TextIOWrapper(raw, encoding="utf-8-sig"))
+        header = [column.strip() for column in next(reader)]
+        missing = [column for column in columns if column not in header]
+        if missing:
+            raise ValueError(f"{name} lacks columns {', '.join(missing)}")
+        pick = itemgetter(*(header.index(column) for column in columns))
+        while True:
+            chunk = [pick(row) for row in itertools.islice(reader, CHUNK_ROWS) if row]
+            if not chunk:
+                return
+            yield tuple(list(values) for values in zip(*chunk)) if len(columns) > 1 else ([v for v in chunk],)
+
+
+def read_columns(archive, name, columns, required=True):
+    """Read selected columns of a small GTFS file as lists"""
+    result = tuple([] for _ in columns)
+    for chunk in iter_columns(archive, name, columns, required):
+        for values, more in zip(result, chunk):
+            values.extend(more)
+    return result
+
+
+class Feed:
+    """
+    A GTFS static feed held in NumPy arrays
+    """
+
+    def __init__(self, path):
+        with zipfile.ZipFile(path) as archive:
+            self._load_stops(archive)
+            self._load_trips(archive)
+            self._load_stop_times(archive)
+            self._load_calendar(archive)
+        self._build_transfers()
+        logger.info(
+            f"Loaded GTFS feed: {len(self.stop_ids)} stops, {len(self.trip_ids)} trips, "
+            f"{len(self.stop_time_stop)} stop times, {len(self.transfer_to)} transfers"
+        )
+
+    def _load_stops(self, archive):
+        stop_ids, names, latitudes, longitudes = read_columns(
+            archive, "stops.txt", ("stop_id", "stop_name", "stop_lat", "stop_lon")
+        )
+        self.stop_ids = stop_ids
+        self.stop_names = names
+        self.stop_latitude = np.array(latitudes, dtype=np.float64)
+        self.stop_longitude = np.array(longitudes, dtype=np.float64)
+        self.stop_x, self.stop_y = project(self.stop_latitude, self.stop_longitude)
+        self.stop_index = {stop_id: i for i, stop_id in enumerate(stop_ids)}
+
+    def _load_trips(self, archive):
+        route_ids, short_names = read_columns(archive, "routes.txt", ("route_id", "route_short_name"))
+        route_index = {route_id: i for i, route_id in enumerate(route_ids)}
+        self.route_names = short_names
+
+        trip_routes, services, trip_ids = read_columns(archive, "trips.txt", ("route_id", "service_id", "trip_id"))
+        try:
+            (headsigns,) = read_columns(archive, "trips.txt", ("trip_headsign",))
+        except ValueError:
+            headsigns = [""] * len(trip_ids)
+        self.trip_ids = trip_ids
+        self.trip_headsigns = headsigns
+        self.trip_index = {trip_id: i for i, trip_id in enumerate(trip_ids)}
+        self.trip_route = np.array([route_index[r] for r in trip_routes], dtype=np.int32)
+        self.service_ids = sorted(set(services))
+        service_index = {service: i for i, service in enumerate(self.service_ids)}
+        self.trip_service = np.array([service_index[s] for s in services], dtype=np.int32)
+
+    def _load_stop_times(self, archive):
+        trips, stops, sequences, arrivals, departures = [], [], [], [], []
+        trip_index, stop_index = self.trip_index, self.stop_index
+        columns = ("trip_id", "stop_id", "stop_sequence", "arrival_time", "departure_time")
+        for trip_ids, stop_ids, sequence, arrival, departure in iter_columns(archive, "stop_times.txt", columns):
+            trips.append(np.array([trip_index[t] for t in trip_ids], dtype=np.int32))
+            stops.append(np.array([stop_index[s] for s in stop_ids], dtype=np.int32))
+            sequences.append(np.array(sequence, dtype=np.int32))
+            arrivals.append(np.array([parse_time(t) for t in arrival], dtype=np.int32))
+            departures.append(np.array([parse_time(t) for t in departure], dtype=np.int32))
+
+        trip = np.concatenate(trips)
+        sequence = np.concatenate(sequences)
+        order = np.lexsort((sequence, trip))
+        self.stop_time_trip = trip[order]
+        self.stop_time_stop = np.concatenate(stops)[order]
+        arrival = np.concatenate(arrivals)[order]
+        departure = np.concatenate(departures)[order]
+
+        # Fill stop times without a time by interpolating inside each trip;
+        # GTFS requires the first and last stop of a trip to be timed
+        for times in (arrival, departure):
+            known = times >= 0
+            if not known.all():
+                rows = np.arange(len(times))
+                times[~known] = np.interp(rows[~known], rows[known], times[known])
+        missing_arrival = arrival < 0
+        arrival[missing_arrival] = departure[missing_arrival]
+        self.stop_time_arrival = arrival
+        self.stop_time_departure = departure
+        self.trip_start = np.searchsorted(self.stop_time_trip, np.arange(len(self.trip_ids) + 1))
+
+    def _load_calendar(self, archive):
+        count = len(self.service_ids)
+        service_index = {service: i for i, service in enumerate(self.service_ids)}
+        self.service_weekdays = np.zeros((count, 7), dtype=bool)
+        self.service_start = np.zeros(count, dtype=np.int64)
+        self.service_end = np.zeros(count, dtype=np.int64)
+
+        for columns in iter_columns(archive, "calendar.txt", ("service_id", "start_date", "end_date") + WEEKDAYS, required=False):
+            for service, start, end, *days in zip(*columns):
+                if service in service_index:
+                    i = service_index[service]
+                    self.service_start[i] = int(start)
+                    self.service_end[i] = int(end)
+                    self.service_weekdays[i] = [day.strip() == "1" for day in days]
+
+        # Exceptions: date -> (services added, services removed)
+        self.service_exceptions = {}
+        for columns in iter_columns(archive, "calendar_dates.txt", ("service_id", "date", "exception_type"), required=False):
+            for service, day, exception in zip(*columns):
+                if service in service_index:
+                    added, removed = self.service_exceptions.setdefault(int(day), (set(), set()))
+                    (added if exception.strip() == "1" else removed).add(service_index[service])
+
+    def _build_transfers(self):
+        start, end, distance = spatial.pairs_within(self.stop_x, self.stop_y, MAX_TRANSFER_WALK_M)
+        order = np.lexsort((end, start))
+        self.transfer_to = end[order].astype(np.int32)
+        self.transfer_time = walk_seconds(distance[order])
+        self.transfer_start = np.searchsorted(start[order], np.arange(len(self.stop_ids) + 1))
+
+    def active_services(self, day):
+        """Indexes of the services running on a date"""
+        key = day.year * 10000 + day.month * 100 + day.day
+        active = self.service_weekdays[:, day.weekday()] & (self.service_start <= key) & (key <= self.service_end)
+        added, removed = self.service_exceptions.get(key, ((), ()))
+        active[list(added)] = True
+        active[list(removed)] = False
+        return np.flatnonzero(active)
+
+    def stops_near(self, latitude, longitude, radius):
+        """Stops within walking distance of a point, with walking times"""
+        x, y = project(latitude, longitude)
+        distance = np.hypot(self.stop_x - x, self.stop_y - y)
+        stops = np.flatnonzero(distance <= radius)
+        return stops, walk_seconds(distance[stops])
+
+
+class Timetable:
+    """
+    The trips of one service date in the flat RAPTOR layout
+
+    Per position: `position_stop`, `position_pattern`, `position_column`
+    (offset of its column), `position_trips` (trips in the pattern) and
+    `position_index` (stop number within the pattern). Per pattern:
+    `pattern_start` (first position) and the global trip indexes in
+    `pattern_trips[pattern_trip_start[r]:pattern_trip_start[r + 1]]`.
+    """
+
+    def __init__(self, feed, day):
+        self.feed = feed
+        self.day = day
+        services = feed.active_services(day)
+        running = np.isin(feed.trip_service, services)
+        running &= np.diff(feed.trip_start) >= 2
+
+        # Group trips by stop sequence
+        sequences = {}
+        for trip in np.flatnonzero(running).tolist():
+            stops = feed.stop_time_stop[feed.trip_start[trip]:feed.trip_start[trip + 1]]
+            sequences.setdefault(stops.tobytes(), []).append(trip)
+
+        patterns = []
+        for trips in sequences.values():
+            patterns.extend(self._split_overtaking(trips))
+
+        position_stop, position_pattern, position_index = [], [], []
+        pattern_start, pattern_trips, pattern_trip_start = [0], [], [0]
+        departure_columns, arrival_columns, column_start = [], [], []
+        offset = 0
+        for r, (trips, departures, arrivals) in enumerate(patterns):
+            n_trips, n_stops = departures.shape
+            start = feed.trip_start[trips[0]]
+            position_stop.append(feed.stop_time_stop[start:start + n_stops])
+            position_pattern.append(np.full(n_stops, r, dtype=np.int32))
+            position_index.append(np.arange(n_stops, dtype=np.int32))
+            pattern_start.append(pattern_start[-1] + n_stops)
+            pattern_trips.extend(trips)
+            pattern_trip_start.append(len(pattern_trips))
+            # Column-major: all trips at position 0, then all at position 1, ...
+            departure_columns.append(departures.T.ravel())
+            arrival_columns.append(arrivals.T.ravel())
+            column_start.append(offset + np.arange(n_stops) * n_trips)
+            offset += n_trips * n_stops
+
+        def joined(parts, dtype):
+            return np.concatenate(parts).astype(dtype) if parts else np.zeros(0, dtype=dtype)
+
+        self.position_stop = joined(position_stop, np.int64)
+        self.position_pattern = joined(position_pattern, np.int64)
+        self.position_index = joined(position_index, np.int64)
+        self.position_column = joined(column_start, np.int64)
+        self.pattern_start = np.array(pattern_start, dtype=np.int64)
+        self.pattern_trips = np.array(pattern_trips, dtype=np.int64)
+        self.pattern_trip_start = np.array(pattern_trip_start, dtype=np.int64)
+        self.position_trips = np.diff(self.pattern_trip_start)[self.position_pattern]
+        self.departure = joined(departure_columns, np.int64)
+        self.arrival = joined(arrival_columns, np.int64)
+
+        column_position = np.repeat(np.arange(len(self.position_stop)), self.position_trips)
+        self.departure_key = column_position * TIME_SPAN + self.departure
+        logger.info(
+            f"Built timetable for {day}: {int(running.sum())} trips in {len(patterns)} patterns, "
+            f"{len(self.position_stop)} positions"
+        )
+
+    def _split_overtaking(self, trips):
+        """Split trips sharing a stop sequence into non-overtaking patterns"""
+        feed = self.feed
+        starts = feed.trip_start[trips]
+        n_stops = int(feed.trip_start[trips[0] + 1] - starts[0])
+        rows = starts[:, None] + np.arange(n_stops)
+        departures = feed.stop_time_departure[rows]
+        arrivals = feed.stop_time_arrival[rows]
+        order = np.lexsort((arrivals[:, -1], departures[:, 0]))
+
+        groups = []
+        for i in order.tolist():
+            for group in groups:
+                last = group[-1]
+                if (departures[i] >= departures[last]).all() and (arrivals[i] >= arrivals[last]).all():
+                    group.append(i)
+                    break
+            else:
+                groups.append([i])
+        return [
+            ([trips[i] for i in group], departures[group], arrivals[group])
+            for group in groups
+        ]
@@ -0,0 +1,279 @@
+"""
+Headways and bus bunching per line variant
+
+For every snapshot the fleet is grouped by (line, subline) and each bus is
+placed along its route. Consecutive buses give the spacing and the headway,
+i.e. how long the follower needs to reach where its leader is now. All of
+it is computed for the whole fleet in one vectorized pass.
+
+Progress along the route comes from RouteGeometry, the stop sequences of
+the line's GTFS trips. Each (line, subline) group is matched to the
+sequence its buses fit best, taking their heading into account, and every
+bus is projected onto it. Buses far from the route, and whole groups when
+no geometry is loaded or the line has no good fit, get no spacing and no
+status rather than a guess.
+"""
+import numpy as np
+
+import gtfs
+import snapshots
+from analytics import METERS_PER_DEGREE, MAX_SPEED_GAP_S, MAX_PLAUSIBLE_SPEED_KMH
+
+# Used while a line has no measured speed yet (about 18 km/h)
+DEFAULT_SPEED_MS = 5.0
+# Weight of the newest measurement in the smoothed line speed
+SPEED_SMOOTHING = 0.2
+# Headways relative to the variant's mean headway
+BUNCHING_RATIO = 0.25
+GAP_RATIO = 2.0
+# Buses farther than this from their variant's route are not placed on it;
+# routes are drawn stop to stop, so corners cut off some distance
+MAX_ROUTE_OFFSET_M = 150
+# Added to a moving bus's distance from a segment running the other way
+WRONG_WAY_PENALTY_M = 500
+
+STATUS_LEADING = 0
+STATUS_OK = 1
+STATUS_BUNCHED = 2
+STATUS_GAP = 3
+STATUS_UNKNOWN = 4
+STATUS_NAMES = ("leading", "ok", "bunched", "gap", None)
+
+
+class LineSpeedTracker:
+    """
+    Smoothed speed of every line, measured between consecutive snapshots
+
+    The last fix of every vehicle is kept in arrays indexed by vehicle code,
+    so matching a snapshot against the previous one is a single gather.
+    """
+
+    def __init__(self):
+        self.last_t = np.zeros(0, dtype=np.float64)
+        self.last_latitude = np.zeros(0, dtype=np.float64)
+        self.last_longitude = np.zeros(0, dtype=np.float64)
+        self.speed = np.zeros(0, dtype=np.float64)
+
+    def update(self, snapshot, n_vehicles, n_lines):
+        """Fold a snapshot in and return the speed per line code in m/s"""
+        self.last_t = _grown(self.last_t, n_vehicles)
+        self.last_latitude = _grown(self.last_latitude, n_vehicles)
+        self.last_longitude = _grown(self.last_longitude, n_vehicles)
+        self.speed = _grown(self.speed, n_lines)
+
+        vehicle = snapshot.vehicle
+        dt = snapshot.taken_at - self.last_t[vehicle]
+        dx = (snapshot.longitude - self.last_longitude[vehicle]) * METERS_PER_DEGREE * np.cos(np.radians(snapshot.latitude))
+        dy = (snapshot.latitude - self.last_latitude[vehicle]) * METERS_PER_DEGREE
+        distance = np.sqrt(dx * dx + dy * dy)
+        valid = (self.last_t[vehicle] > 0) & (dt > 0) & (dt <= MAX_SPEED_GAP_S)
+        valid &= distance / np.maximum(dt, 1) * 3.6 <= MAX_PLAUSIBLE_SPEED_KMH
+
+        line = snapshot.line[valid]
+        distance_m = np.bincount(line, weights=distance[valid], minlength=n_lines)
+        elapsed_s = np.bincount(line, weights=dt[valid], minlength=n_lines)
+        measured = elapsed_s > 0
+        current = np.zeros(n_lines)
+        current[measured] = distance_m[measured] / elapsed_s[measured]
+        fresh = measured & (self.speed == 0)
+        self.speed[fresh] = current[fresh]
+        smoothed = measured & ~fresh
+        self.speed[smoothed] += SPEED_SMOOTHING * (current[smoothed] - self.speed[smoothed])
+
+        self.last_t[vehicle] = snapshot.taken_at
+        self.last_latitude[vehicle] = snapshot.latitude
+        self.last_longitude[vehicle] = snapshot.longitude
+        return np.where(self.speed > 0, self.speed, DEFAULT_SPEED_MS)
+
+
+def _grown(array, size):
+    if len(array) >= size:
+        return array
+    grown = np.zeros(max(size, 2 * len(array)), dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+class RouteGeometry:
+    """
+    Route polylines of every line, from the stop sequences of GTFS trips
+
+    Every distinct stop sequence of a route is one variant, drawn as
+    straight segments between consecutive stops. The segments of all
+    variants sit in flat arrays, grouped by line and then by variant, and
+    `line_segments` maps a route short name to its (start, end) slice.
+    """
+
+    def __init__(self, feed):
+        sequences = {}
+        for trip in range(len(feed.trip_ids)):
+            stops = feed.stop_time_stop[feed.trip_start[trip]:feed.trip_start[trip + 1]]
+            if len(stops) >= 2:
+                name = feed.route_names[feed.trip_route[trip]]
+                sequences.setdefault(name, {}).setdefault(stops.tobytes(), stops)
+
+        columns = {name: [] for name in ("x", "y", "dx", "dy", "length", "along", "variant")}
+        self.line_segments = {}
+        offset = variant = 0
+        for name, variants in sequences.items():
+            start = offset
+            for stops in variants.values():
+                x, y = feed.stop_x[stops], feed.stop_y[stops]
+                dx, dy = np.diff(x), np.diff(y)
+                length = np.hypot(dx, dy)
+                along = np.concatenate(([0.0], np.cumsum(length)[:-1]))
+                keep = length > 0
+                for column, values in (
+                    ("x", x[:-1]), ("y", y[:-1]), ("dx", dx), ("dy", dy),
+                    ("length", length), ("along", along), ("variant", np.full(len(dx), variant))
+                ):
+                    columns[column].append(values[keep])
+                offset += int(keep.sum())
+                variant += 1
+            if offset > start:
+                self.line_segments[str(name)] = (start, offset)
+
+        def joined(parts, dtype):
+            return np.concatenate(parts).astype(dtype) if parts else np.zeros(0, dtype=dtype)
+
+        self.x = joined(columns["x"], np.float64)
+        self.y = joined(columns["y"], np.float64)
+        self.dx = joined(columns["dx"], np.float64)
+        self.dy = joined(columns["dy"], np.float64)
+        self.length = joined(columns["length"], np.float64)
+        self.along = joined(columns["along"], np.float64)
+        self.variant = joined(columns["variant"], np.int64)
+        self.variant_count = variant
+
+    def segment_ranges(self, line_codes):
+        """(start, end) segment slices for an array of line codes"""
+        start = np.zeros(len(line_codes), dtype=np.int64)
+        end = np.zeros(len(line_codes), dtype=np.int64)
+        codes, inverse = np.unique(line_codes, return_inverse=True)
+        for i, code in enumerate(codes.tolist()):
+            bounds = self.line_segments.get(snapshots.lines.values[code])
+            if bounds is not None:
+                start[inverse == i], end[inverse == i] = bounds
+        return start, end
+
+    def locate(self, snapshot, group, n_groups):
+        """
+        Progress of every bus along its group's best-fitting variant
+
+        Returns distances in meters from the start of the variant, NaN for
+        buses off the route or in groups without a route.
+        """
+        count = len(snapshot)
+        progress = np.full(count, np.nan)
+        start, end = self.segment_ranges(snapshot.line)
+        n_segments = end - start
+        total = int(n_segments.sum())
+        if total == 0:
+            return progress
+
+        # Every bus against every segment of its line
+        first = np.cumsum(n_segments) - n_segments
+        bus = np.repeat(np.arange(count), n_segments)
+        segment = np.arange(total) - np.repeat(first - start, n_segments)
+        x, y = gtfs.project(snapshot.latitude, snapshot.longitude)
+        px = x[bus] - self.x[segment]
+        py = y[bus] - self.y[segment]
+        dx, dy, length = self.dx[segment], self.dy[segment], self.length[segment]
+        t = np.clip((px * dx + py * dy) / (length * length), 0.0, 1.0)
+        offset = np.hypot(px - t * dx, py - t * dy)
+        along = self.along[segment] + t * length
+
+        # Moving buses should run the way the segment does (compass headings)
+        heading = np.radians(snapshot.heading.astype(np.float64))[bus]
+        wrong_way = (np.sin(heading) * dx + np.cos(heading) * dy < 0) & (snapshot.speed[bus] > 0)
+        cost = offset + WRONG_WAY_PENALTY_M * wrong_way
+
+        # Closest segment of each (bus, variant) pair
+        key = bus * self.variant_count + self.variant[segment]
+        run_start = np.flatnonzero(np.concatenate(([True], key[1:] != key[:-1])))
+        run = np.cumsum(np.concatenate(([False], key[1:] != key[:-1])))
+        best = np.minimum.reduceat(cost, run_start)
+        hits = np.flatnonzero(cost == best[run])
+        _, first_hit = np.unique(run[hits], return_index=True)
+        pick = hits[first_hit]
+        pair_bus, pair_variant = bus[pick], self.variant[segment[pick]]
+
+        # Variant of each group: lowest total cost over its buses
+        pair_group = group[pair_bus]
+        score = np.minimum(best, MAX_ROUTE_OFFSET_M + WRONG_WAY_PENALTY_M)
+        combo, combo_index = np.unique(pair_group * self.variant_count + pair_variant, return_inverse=True)
+        combo_score = np.bincount(combo_index, weights=score)
+        ranked = np.lexsort((combo_score, combo // self.variant_count))
+        ranked_group = combo[ranked] // self.variant_count
+        leaders = ranked[np.concatenate(([True], ranked_group[1:] != ranked_group[:-1]))]
+        chosen = np.full(n_groups, -1, dtype=np.int64)
+        chosen[combo[leaders] // self.variant_count] = combo[leaders] % self.variant_count
+
+        on_route = (pair_variant == chosen[pair_group]) & (best <= MAX_ROUTE_OFFSET_M)
+        progress[pair_bus[on_route]] = along[pick[on_route]]
+        return progress
+
+
+class HeadwayTable:
+    """
+    Headways of one snapshot, ordered by variant and progress along the route
+
+    `order` indexes into the snapshot's arrays. Each variant occupies the
+    slice group_start[g]:group_start[g + 1] and buses within it run from the
+    back of the route to the front, so every bus is followed by its leader;
+    buses that could not be placed on the route come last, with NaN progress
+    and STATUS_UNKNOWN. Without `geometry` no bus is placed.
+    """
+
+    def __init__(self, snapshot, line_speed, geometry=None):
+        self.snapshot = snapshot
+        self.line_speed = line_speed
+        self.geometry = geometry
+        count = len(snapshot)
+
+        # One group per (line, subline) pair
+        key = snapshot.line.astype(np.int64) << 32 | snapshot.subline.astype(np.int64)
+        group_key, group = np.unique(key, return_inverse=True)
+        n_groups = len(group_key)
+        self.group_line = (group_key >> 32).astype(np.int32)
+        self.group_subline = (group_key & 0xFFFFFFFF).astype(np.int32)
+        counts = np.bincount(group, minlength=n_groups)
+
+        if geometry is not None:
+            progress = geometry.locate(snapshot, group, n_groups)
+        else:
+            progress = np.full(count, np.nan)
+
+        # NaN progress sorts after every placed bus of the group
+        order = np.lexsort((progress, group))
+        group = group[order]
+        progress = progress[order]
+        self.order = order
+        self.progress = progress
+        self.group_start = np.concatenate(([0], np.cumsum(counts)))
+
+        # Spacing to the bus ahead; the front bus of each variant has none
+        placed = ~np.isnan(progress)
+        spacing = np.full(count, np.nan)
+        followed = np.zeros(count, dtype=bool)
+        if count:
+            followed[:-1] = (group[1:] == group[:-1]) & placed[1:] & placed[:-1]
+            spacing[:-1][followed[:-1]] = np.diff(progress)[followed[:-1]]
+        self.spacing = spacing
+        self.headway = spacing / line_speed[snapshot.line[order]]
+
+        headway_sum = np.bincount(group[followed], weights=self.headway[followed], minlength=n_groups)
+        headway_count = np.bincount(group[followed], minlength=n_groups)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.mean_headway = headway_sum / headway_count
+            ratio = self.headway / self.mean_headway[group]
+        status = np.full(count, STATUS_UNKNOWN, dtype=np.int8)
+        status[placed] = STATUS_LEADING
+        status[followed] = STATUS_OK
+        status[followed & (ratio < BUNCHING_RATIO)] = STATUS_BUNCHED
+        status[followed & (ratio > GAP_RATIO)] = STATUS_GAP
+        self.status = status
+
+    def groups_for_line(self, line_code):
+        """Indexes of the variant groups that belong to a line"""
+        return np.flatnonzero(self.group_line == line_code)
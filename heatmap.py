@@ -0,0 +1,171 @@
+"""
+Bus density and speed heatmap tiles
+
+Every snapshot is binned into a fixed grid over Montevideo with bincount:
+the number of buses and the sum of their reported speeds per cell. The grid
+is laid out in Web Mercator at MAX_ZOOM, TILE_CELLS cells per tile side, so
+a slippy-map tile z/x/y is a plain slice of the grid, and coarser zooms are
+the grid summed in 2x2 blocks. Besides the latest snapshot, a rolling
+window keeps running totals over the recent snapshots.
+
+The pyramid and the encoded tiles are built on first use after each
+refresh and cached until the next one, so serving tiles costs the same for
+one dashboard as for many.
+"""
+import json
+import math
+import threading
+from collections import deque
+
+import numpy as np
+
+from analytics import MAX_PLAUSIBLE_SPEED_KMH
+
+# Montevideo: (south, west, north, east)
+BOUNDS = (-34.94, -56.44, -34.70, -56.02)
+MIN_ZOOM = 10
+MAX_ZOOM = 14
+TILE_CELLS = 32
+
+LAYERS = ("current", "window")
+
+
+def mercator_cells(latitude, longitude, zoom=MAX_ZOOM):
+    """Fractional Web Mercator cell coordinates (x, y) at a zoom level"""
+    scale = (1 << zoom) * TILE_CELLS
+    latitude = np.radians(np.asarray(latitude, dtype=np.float64))
+    x = (np.asarray(longitude, dtype=np.float64) + 180.0) / 360.0 * scale
+    y = (1.0 - np.log(np.tan(latitude) + 1.0 / np.cos(latitude)) / math.pi) / 2.0 * scale
+    return x, y
+
+
+def downsample(grid):
+    """Sum a grid in 2x2 blocks"""
+    height, width = grid.shape
+    return grid.reshape(height // 2, 2, width // 2, 2).sum(axis=(1, 3))
+
+
+class HeatmapGrid:
+    """
+    Per-cell bus counts and speed sums for the latest snapshot and a window
+    """
+
+    def __init__(self, window_seconds, bounds=BOUNDS):
+        south, west, north, east = bounds
+        x0, y0 = mercator_cells(north, west)
+        x1, y1 = mercator_cells(south, east)
+        # Align the grid to MIN_ZOOM cells so every zoom level is whole blocks
+        block = 1 << (MAX_ZOOM - MIN_ZOOM)
+        self.origin_x = int(x0) // block * block
+        self.origin_y = int(y0) // block * block
+        self.width = -(-(int(x1) + 1 - self.origin_x) // block) * block
+        self.height = -(-(int(y1) + 1 - self.origin_y) // block) * block
+
+        self.window_seconds = window_seconds
+        self._history = deque()
+        self._window_count = np.zeros(self.width * self.height, dtype=np.int64)
+        self._window_speed = np.zeros(self.width * self.height, dtype=np.float64)
+        self._lock = threading.Lock()
+
+    def add(self, snapshot):
+        """Bin a snapshot and slide the window forward"""
+        x, y = mercator_cells(snapshot.latitude, snapshot.longitude)
+        x = np.floor(x).astype(np.int64) - self.origin_x
+        y = np.floor(y).astype(np.int64) - self.origin_y
+        inside = (x >= 0) & (x < self.width) & (y >= 0) & (y < self.height)
+        cells = y[inside] * self.width + x[inside]
+        speed = np.clip(snapshot.speed[inside].astype(np.float64), 0, MAX_PLAUSIBLE_SPEED_KMH)
+        size = self.width * self.height
+
+        with self._lock:
+            # Only the binned buses are kept per snapshot, not whole grids
+            self._history.append((snapshot.taken_at, cells, speed))
+            self._window_count += np.bincount(cells, minlength=size)
+            self._window_speed += np.bincount(cells, weights=speed, minlength=size)
+            while self._history[0][0] <= snapshot.taken_at - self.window_seconds:
+                _, old_cells, old_speed = self._history.popleft()
+                self._window_count -= np.bincount(old_cells, minlength=size)
+                self._window_speed -= np.bincount(old_cells, weights=old_speed, minlength=size)
+
+            return HeatmapTiles(
+                self, snapshot.taken_at,
+                {
+                    "current": (np.bincount(cells, minlength=size), np.bincount(cells, weights=speed, minlength=size), 1),
+                    "window": (self._window_count.copy(), self._window_speed.copy(), len(self._history)),
+                }
+            )
+
+
+class HeatmapTiles:
+    """
+    The tiles of one refresh, encoded on first request and then reused
+    """
+
+    def __init__(self, grid, taken_at, layers):
+        self.grid = grid
+        self.taken_at = taken_at
+        self._layers = layers
+        self._levels = {}
+        self._tiles = {}
+        self._lock = threading.Lock()
+
+    def tile(self, layer, z, x, y):
+        """JSON bytes of one tile, or None outside the served zoom levels"""
+        if layer not in LAYERS or not MIN_ZOOM <= z <= MAX_ZOOM:
+            return None
+        key = (layer, z, x, y)
+        with self._lock:
+            encoded = self._tiles.get(key)
+            if encoded is None:
+                encoded, covered = self._encode(layer, z, x, y)
+                # Only tiles over the grid are cached, which bounds the cache
+                if covered:
+                    self._tiles[key] = encoded
+            return encoded
+
+    def _level(self, layer, z):
+        # Grids for coarser zooms are summed from the next finer one
+        level = self._levels.get((layer, z))
+        if level is None:
+            if z == MAX_ZOOM:
+                count, speed, snapshots = self._layers[layer]
+                shape = (self.grid.height, self.grid.width)
+                level = (count.reshape(shape), speed.reshape(shape), snapshots)
+            else:
+                count, speed, snapshots = self._level(layer, z + 1)
+                level = (downsample(count), downsample(speed), snapshots)
+            self._levels[(layer, z)] = level
+        return level
+
+    def _encode(self, layer, z, x, y):
+        count, speed, snapshots = self._level(layer, z)
+        shift = MAX_ZOOM - z
+        # Tile bounds in this level's cells, clipped to the grid
+        left = x * TILE_CELLS - (self.grid.origin_x >> shift)
+        top = y * TILE_CELLS - (self.grid.origin_y >> shift)
+        height, width = count.shape
+        x0, x1 = max(left, 0), min(left + TILE_CELLS, width)
+        y0, y1 = max(top, 0), min(top + TILE_CELLS, height)
+
+        cell, density, mean_speed = [], [], []
+        covered = x0 < x1 and y0 < y1
+        if covered:
+            block_count = count[y0:y1, x0:x1]
+            rows, columns = np.nonzero(block_count)
+            hits = block_count[rows, columns]
+            cell = ((rows + y0 - top) * TILE_CELLS + columns + x0 - left).tolist()
+            density = np.round(hits / max(snapshots, 1), 3).tolist()
+            mean_speed = np.round(speed[y0:y1, x0:x1][rows, columns] / hits, 1).tolist()
+
+        encoded = json.dumps({
+            "z": z,
+            "x": x,
+            "y": y,
+            "layer": layer,
+            "size": TILE_CELLS,
+            "snapshots": snapshots,
+            "cell": cell,
+            "density": density,
+            "speed_kmh": mean_speed
+        }, separators=(",", ":")).encode()
+        return encoded, covered
@@ -68,6 +68,7 @@ def install_dependencies():
             "flask",
             "flask-sqlalchemy",
             "gunicorn",
+            "numpy",
             "requests",
             "psycopg2-binary",
             "email-validator"
@@ -136,7 +137,7 @@ After=network.target
 [Service]
 User={os.getlogin()}
 WorkingDirectory={app_path}
-ExecStart={app_path}/venv/bin/gunicorn --bind 0.0.0.0:5000 main:app
+ExecStart={app_path}/venv/bin/gunicorn --bind 0.0.0.0:5000 --worker-class gthread --threads 8 main:app
 Restart=always
 Environment="MONTEVIDEO_CLIENT_ID={os.environ.get('MONTEVIDEO_CLIENT_ID', '')}"
 Environment="MONTEVIDEO_CLIENT_SECRET={os.environ.get('MONTEVIDEO_CLIENT_SECRET', '')}"
@@ -219,7 +220,7 @@ def print_completion_message():
     print(f"{BOLD}{GREEN}=================================================={RESET}")
     print(f"\nPara iniciar la aplicación manualmente, ejecute:")
     print(f"  source venv/bin/activate  # Si está usando entorno virtual")
-    print(f"  gunicorn --bind 0.0.0.0:5000 main:app")
+    print(f"  gunicorn --bind 0.0.0.0:5000 --worker-class gthread --threads 8 main:app")
     print(f"\nLa aplicación estará disponible en: http://localhost:5000")
     print(f"\n{YELLOW}Recuerde configurar su firewall si desea acceder desde otras máquinas.{RESET}")
 
@@ -0,0 +1,208 @@
+"""
+Request stage timing and an on-demand sampling profiler
+
+Stage timers measure where a request spends its time (token, upstream I/O,
+JSON decoding, normalization, jsonify, ...) and are reported in the
+Server-Timing header. Stages nest: a stage's time excludes the stages that
+ran inside it, so decoding a streamed body is not also counted as upstream
+I/O. With timings disabled, stage() hands back a shared no-op context
+manager and timed_iter() returns its argument, so the hooks cost one
+attribute check. Work handed to other threads is wrapped with propagate(),
+which adds its stages to the request, summed over the threads.
+
+SamplingProfiler snapshots the stack of every thread at a fixed interval
+for a limited time and aggregates them as collapsed stacks, one
+"frame;frame;frame count" line per distinct stack, the input format of
+flamegraph.pl and speedscope.
+"""
+import collections
+import contextlib
+import os
+import sys
+import threading
+import time
+
+SAMPLE_INTERVAL_S = 0.01
+MAX_PROFILE_SECONDS = 300
+
+enabled = False
+
+_local = threading.local()
+_NULL_STAGE = contextlib.nullcontext()
+
+
+class _Stage:
+    __slots__ = ("name", "totals", "stack", "start", "children")
+
+    def __init__(self, name, totals, stack):
+        self.name = name
+        self.totals = totals
+        self.stack = stack
+
+    def __enter__(self):
+        self.children = 0.0
+        self.stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        self.stack.pop()
+        self.totals[self.name] = self.totals.get(self.name, 0.0) + elapsed - self.children
+        if self.stack:
+            self.stack[-1].children += elapsed
+        return False
+
+
+def begin():
+    """Start collecting stage timings for the current request"""
+    if enabled:
+        _local.totals = {}
+        _local.stack = []
+        _local.started = time.perf_counter()
+
+
+def finish():
+    """Stop collecting and return the Server-Timing header value, or None"""
+    totals = getattr(_local, "totals", None)
+    if totals is None:
+        return None
+    total = time.perf_counter() - _local.started
+    _local.totals = None
+    metrics = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in totals.items()]
+    metrics.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(metrics)
+
+
+def stage(name):
+    """Context manager timing one stage of the current request"""
+    if not enabled:
+        return _NULL_STAGE
+    totals = getattr(_local, "totals", None)
+    if totals is None:
+        return _NULL_STAGE
+    return _Stage(name, totals, _local.stack)
+
+
+def timed_iter(name, iterable):
+    """Wrap an iterable so the time spent producing items counts as a stage"""
+    if not enabled or getattr(_local, "totals", None) is None:
+        return iterable
+    return _timed_iter(name, iterable)
+
+
+def _timed_iter(name, iterable):
+    iterator = iter(iterable)
+    while True:
+        with stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def propagate(function):
+    """
+    Wrap a function to run on a worker thread so that its stage timings
+    count toward the current request
+    """
+    totals = getattr(_local, "totals", None) if enabled else None
+    if totals is None:
+        return function
+    lock = threading.Lock()
+
+    def timed(*args, **kwargs):
+        _local.totals = {}
+        _local.stack = []
+        try:
+            return function(*args, **kwargs)
+        finally:
+            with lock:
+                for name, seconds in _local.totals.items():
+                    totals[name] = totals.get(name, 0.0) + seconds
+            _local.totals = None
+
+    return timed
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all threads for a limited time
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL_S):
+        self.interval = interval
+        self.started_at = None
+        self.stopping_at = None
+        self.samples = 0
+        self._stacks = collections.Counter()
+        self._labels = {}
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds):
+        """Start sampling for `seconds`; returns False if already running"""
+        with self._lock:
+            if self.running:
+                return False
+            self.started_at = time.time()
+            self.stopping_at = self.started_at + min(max(seconds, 1), MAX_PROFILE_SECONDS)
+            self.samples = 0
+            self._stacks = collections.Counter()
+            self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+            self._thread.start()
+        return True
+
+    def stop(self):
+        self.stopping_at = time.time()
+
+    def status(self):
+        return {
+            "running": self.running,
+            "started_at": self.started_at,
+            "stopping_at": self.stopping_at,
+            "samples": self.samples,
+            "interval_ms": self.interval * 1000,
+            "stacks": len(self._stacks)
+        }
+
+    def collapsed(self):
+        """Aggregated stacks in collapsed format, most frequent first"""
+        with self._lock:
+            stacks = self._stacks.most_common()
+        return "".join(f"{stack} {count}\n" for stack, count in stacks)
+
+    def _run(self):
+        own = threading.get_ident()
+        while time.time() < self.stopping_at:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            frames = sys._current_frames()
+            sampled = []
+            for ident, frame in frames.items():
+                if ident != own:
+                    sampled.append(self._collapse(names.get(ident, str(ident)), frame))
+            with self._lock:
+                self._stacks.update(sampled)
+                self.samples += 1
+            del frames
+            time.sleep(self.interval)
+
+    def _collapse(self, thread_name, frame):
+        labels = self._labels
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            label = labels.get(code)
+            if label is None:
+                label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                labels[code] = label.replace(";", ":")
+                label = labels[code]
+            stack.append(label)
+            frame = frame.f_back
+        stack.append(thread_name.replace(";", ":").replace(" ", "_"))
+        return ";".join(reversed(stack))
@@ -0,0 +1,274 @@
+"""
+Journey planning with RAPTOR over a gtfs.Timetable
+
+RAPTOR works in rounds: round k finds the earliest arrival at every stop
+using at most k buses. Each round here is a fixed number of whole-array
+NumPy operations instead of a loop over routes:
+
+1. Boarding: one searchsorted over the departure columns finds, at every
+   position whose stop improved in the previous round, the first trip that
+   can still be caught there.
+2. Riding: the boarded (trip, position) pairs are packed into one integer
+   per position and carried forward along each pattern with
+   np.maximum.accumulate, which keeps the earliest trip boarded so far.
+3. Alighting: arrivals are read from the arrival columns and reduced to the
+   best one per stop, then walking transfers are relaxed from the improved
+   stops.
+
+The result is the Pareto set of journeys by arrival time and number of
+buses, each reconstructed into walk and bus legs.
+"""
+import numpy as np
+
+import gtfs
+
+MAX_ROUNDS = 5
+MAX_ACCESS_WALK_M = 800
+
+# Pack (pattern, trip, position in pattern) for the riding scan
+_POSITIONS = 1 << 12
+_TRIPS = 1 << 16
+_PATTERN = _POSITIONS * _TRIPS
+
+_UNREACHED = np.iinfo(np.int64).max // 4
+
+# How a stop was reached in a round
+_NONE = 0
+_BUS = 1
+_WALK = 2
+
+
+def format_time(seconds):
+    """HH:MM:SS of a service time, wrapping times past midnight"""
+    seconds = int(seconds) % 86400
+    return f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+def first_per_group(group, value):
+    """Indexes of the smallest value in every group"""
+    order = np.lexsort((value, group))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = group[order][1:] != group[order][:-1]
+    return order[first]
+
+
+class Planner:
+    """
+    RAPTOR queries over one service date
+    """
+
+    def __init__(self, timetable):
+        if len(timetable.pattern_trips) and (
+            timetable.position_trips.max() >= _TRIPS - 1 or np.diff(timetable.pattern_start).max() >= _POSITIONS
+        ):
+            raise ValueError("Timetable has patterns too large for the planner")
+        self.timetable = timetable
+        self.feed = timetable.feed
+        self.pattern_first = np.zeros(len(timetable.position_stop), dtype=bool)
+        self.pattern_first[timetable.pattern_start[:-1]] = True
+        self.pattern_base = timetable.position_pattern * _PATTERN
+
+    def plan(self, origin, destination, departure, max_rounds=MAX_ROUNDS):
+        """
+        Journeys from origin to destination leaving at `departure`
+
+        origin and destination are (latitude, longitude); departure is in
+        seconds after midnight of the service date. Returns a list of
+        journeys, fewest buses first, each faster than the previous one.
+        """
+        feed = self.feed
+        access_stops, access_time = feed.stops_near(origin[0], origin[1], MAX_ACCESS_WALK_M)
+        egress_stops, egress_time = feed.stops_near(destination[0], destination[1], MAX_ACCESS_WALK_M)
+
+        arrival = np.full(len(feed.stop_ids), _UNREACHED, dtype=np.int64)
+        arrival[access_stops] = departure + access_time
+        best = arrival.copy()
+        rounds = [arrival]
+        labels = [None]
+        marked = access_stops
+
+        for _ in range(max_rounds):
+            if not len(marked):
+                break
+            target = int(np.min(best[egress_stops] + egress_time, initial=_UNREACHED))
+            arrival, label, marked = self._round(rounds[-1], best, marked, target)
+            rounds.append(arrival)
+            labels.append(label)
+
+        journeys = []
+        walk_distance = float(np.hypot(*(np.subtract(gtfs.project(*origin), gtfs.project(*destination)))))
+        if walk_distance <= 2 * MAX_ACCESS_WALK_M:
+            walk = int(gtfs.walk_seconds(walk_distance))
+            journeys.append(self._journey([self._walk_leg(None, None, departure, departure + walk)]))
+        fastest = journeys[0]["arrival_s"] if journeys else _UNREACHED
+        for k in range(1, len(rounds)):
+            at_destination = rounds[k][egress_stops] + egress_time
+            if not len(at_destination):
+                break
+            i = int(np.argmin(at_destination))
+            if at_destination[i] >= fastest:
+                continue
+            fastest = int(at_destination[i])
+            journeys.append(self._reconstruct(
+                rounds, labels, k, int(egress_stops[i]), int(egress_time[i]), access_stops, access_time
+            ))
+        return journeys
+
+    def _round(self, previous, best, marked, target):
+        """One RAPTOR round; returns (arrivals, labels, improved stops)"""
+        timetable = self.timetable
+        stop_of = timetable.position_stop
+        arrival = previous.copy()
+
+        # Board: first catchable trip at every position of a marked stop
+        is_marked = np.zeros(len(previous), dtype=bool)
+        is_marked[marked] = True
+        boarding = np.flatnonzero(is_marked[stop_of])
+        column = np.searchsorted(timetable.departure_key, boarding * gtfs.TIME_SPAN + previous[stop_of[boarding]])
+        trip = column - timetable.position_column[boarding]
+        catchable = trip < timetable.position_trips[boarding]
+        boarding, trip = boarding[catchable], trip[catchable]
+
+        # Ride: carry the earliest boarded trip forward along each pattern
+        packed = self.pattern_base.copy()
+        packed[boarding] += (_TRIPS - 1 - trip) * _POSITIONS + timetable.position_index[boarding]
+        packed = np.maximum.accumulate(packed)
+        carried = np.empty_like(packed)
+        carried[1:] = packed[:-1]
+        carried[0] = 0
+        carried[self.pattern_first] = self.pattern_base[self.pattern_first]
+        carried -= self.pattern_base
+        riding = np.flatnonzero(carried > 0)
+        boarded_trip = _TRIPS - 1 - carried[riding] // _POSITIONS
+        boarded_at = carried[riding] % _POSITIONS
+
+        # Alight: best arrival per stop, pruned by the best known arrivals
+        # and the best arrival at the destination so far
+        reached = timetable.arrival[timetable.position_column[riding] + boarded_trip]
+        stop = stop_of[riding]
+        better = reached < np.minimum(best[stop], target)
+        riding, boarded_trip, boarded_at, reached, stop = (
+            a[better] for a in (riding, boarded_trip, boarded_at, reached, stop)
+        )
+        keep = first_per_group(stop, reached)
+        riding, boarded_trip, boarded_at, reached, stop = (
+            a[keep] for a in (riding, boarded_trip, boarded_at, reached, stop)
+        )
+        arrival[stop] = reached
+        best[stop] = reached
+
+        label = {
+            "how": np.zeros(len(previous), dtype=np.int8),
+            "position": np.zeros(len(previous), dtype=np.int64),
+            "trip": np.zeros(len(previous), dtype=np.int64),
+            "boarded_at": np.zeros(len(previous), dtype=np.int64),
+            "from_stop": np.zeros(len(previous), dtype=np.int64),
+        }
+        label["how"][stop] = _BUS
+        label["position"][stop] = riding
+        label["trip"][stop] = boarded_trip
+        label["boarded_at"][stop] = boarded_at
+
+        # Walk: transfers from the stops a bus improved
+        feed = self.feed
+        starts = feed.transfer_start[stop]
+        counts = feed.transfer_start[stop + 1] - starts
+        edge = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(int(counts.sum()))
+        walk_from = np.repeat(stop, counts)
+        walk_to = feed.transfer_to[edge].astype(np.int64)
+        walked = arrival[walk_from] + feed.transfer_time[edge]
+        better = walked < np.minimum(best[walk_to], target)
+        walk_from, walk_to, walked = walk_from[better], walk_to[better], walked[better]
+        keep = first_per_group(walk_to, walked)
+        walk_from, walk_to, walked = walk_from[keep], walk_to[keep], walked[keep]
+        arrival[walk_to] = walked
+        best[walk_to] = walked
+        label["how"][walk_to] = _WALK
+        label["from_stop"][walk_to] = walk_from
+
+        return arrival, label, np.union1d(stop, walk_to)
+
+    def _reconstruct(self, rounds, labels, k, stop, egress, access_stops, access_time):
+        """Trace a journey back from its last stop in round k"""
+        timetable = self.timetable
+        legs = [self._walk_leg(stop, None, rounds[k][stop], rounds[k][stop] + egress)]
+        while k > 0:
+            label = labels[k]
+            how = label["how"][stop]
+            if how == _NONE:
+                k -= 1
+            elif how == _WALK:
+                origin = int(label["from_stop"][stop])
+                legs.append(self._walk_leg(origin, stop, rounds[k][origin], rounds[k][stop]))
+                stop = origin
+            else:
+                position = int(label["position"][stop])
+                pattern = int(timetable.position_pattern[position])
+                trip = int(label["trip"][stop])
+                board = int(timetable.pattern_start[pattern] + label["boarded_at"][stop])
+                legs.append(self._bus_leg(pattern, trip, board, position))
+                stop = int(timetable.position_stop[board])
+                k -= 1
+        walk = int(access_time[np.searchsorted(access_stops, stop)])
+        legs.append(self._walk_leg(None, stop, rounds[0][stop] - walk, rounds[0][stop]))
+        legs.reverse()
+
+        # Leave as late as the first bus allows rather than at the query time
+        if len(legs) > 1 and legs[1]["mode"] == "bus":
+            legs[0]["arrival_s"] = legs[1]["departure_s"]
+            legs[0]["departure_s"] = legs[1]["departure_s"] - walk
+        legs = [leg for leg in legs if leg["mode"] == "bus" or leg["arrival_s"] > leg["departure_s"]]
+        return self._journey(legs)
+
+    def _journey(self, legs):
+        departure, arrival = legs[0]["departure_s"], legs[-1]["arrival_s"]
+        for leg in legs:
+            leg["departure"] = format_time(leg["departure_s"])
+            leg["arrival"] = format_time(leg["arrival_s"])
+        return {
+            "departure": format_time(departure),
+            "arrival": format_time(arrival),
+            "departure_s": int(departure),
+            "arrival_s": int(arrival),
+            "duration_min": round((arrival - departure) / 60, 1),
+            "transfers": max(sum(1 for leg in legs if leg["mode"] == "bus") - 1, 0),
+            "legs": legs,
+        }
+
+    def _stop(self, stop):
+        if stop is None:
+            return None
+        feed = self.feed
+        return {
+            "id": feed.stop_ids[stop],
+            "name": feed.stop_names[stop],
+            "latitude": float(feed.stop_latitude[stop]),
+            "longitude": float(feed.stop_longitude[stop]),
+        }
+
+    def _walk_leg(self, start, end, departure, arrival):
+        return {
+            "mode": "walk",
+            "from": self._stop(start),
+            "to": self._stop(end),
+            "departure_s": int(departure),
+            "arrival_s": int(arrival),
+        }
+
+    def _bus_leg(self, pattern, trip, board, alight):
+        timetable = self.timetable
+        feed = self.feed
+        trip_count = int(timetable.pattern_trip_start[pattern + 1] - timetable.pattern_trip_start[pattern])
+        trip_id = int(timetable.pattern_trips[timetable.pattern_trip_start[pattern] + trip])
+        return {
+            "mode": "bus",
+            "line": feed.route_names[feed.trip_route[trip_id]],
+            "destination": feed.trip_headsigns[trip_id],
+            "trip": feed.trip_ids[trip_id],
+            "from": self._stop(int(timetable.position_stop[board])),
+            "to": self._stop(int(timetable.position_stop[alight])),
+            "departure_s": int(timetable.departure[timetable.position_column[board] + trip]),
+            "arrival_s": int(timetable.arrival[timetable.position_column[alight] + trip]),
+            "stops": int(alight - board),
+            "trips_in_pattern": trip_count,
+        }
@@ -0,0 +1,345 @@
+"""
+Columnar snapshots of the bus fleet
+
+Every fleet refresh is turned into a Snapshot: one NumPy array per field
+instead of a list of dicts. The fields are pulled out of the API records
+into BusColumns as the decoded batches arrive, so no formatted dict is
+built per bus; the dicts served by /api/buses are assembled from the
+columns only when asked for. Strings such as bus ids, line numbers and
+destinations are interned in module-level string tables, so their integer
+codes stay stable across snapshots and can be grouped on directly.
+
+Snapshots are appended to a PositionStore, which keeps the recorded positions
+of the last few days as growable columnar arrays ordered by time.
+"""
+import collections
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+
+def to_float(value, default=0.0):
+    """Convert an API value to float, falling back to a default"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def to_floats(values, dtype):
+    """Convert a list of API values to an array, non-numbers becoming 0"""
+    try:
+        array = np.array(values, dtype=dtype)
+        if not np.isnan(array).any():
+            return array
+    except (TypeError, ValueError):
+        pass
+    return np.fromiter((to_float(value) for value in values), dtype=dtype, count=len(values))
+
+
+class StringTable:
+    """
+    Interns strings to stable integer codes
+    """
+
+    def __init__(self):
+        self._codes = {}
+        self.values = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.values)
+
+    def code(self, value):
+        """Return the code for a value, adding it to the table if needed"""
+        code = self._codes.get(value)
+        if code is None:
+            with self._lock:
+                code = self._codes.get(value)
+                if code is None:
+                    code = len(self.values)
+                    self.values.append(value)
+                    self._codes[value] = code
+        return code
+
+    def lookup(self, value):
+        """Return the code for a value, or -1 if it was never seen"""
+        return self._codes.get(value, -1)
+
+    def encode(self, values, count=-1):
+        """Intern an iterable of strings into an int32 code array"""
+        return np.fromiter((self.code(str(value)) for value in values), dtype=np.int32, count=count)
+
+    def decode(self, codes):
+        """Turn an array of codes back into a list of strings"""
+        values = self.values
+        return [values[code] for code in codes]
+
+
+# Shared tables: codes are comparable across every snapshot of the process
+vehicles = StringTable()
+lines = StringTable()
+sublines = StringTable()
+destinations = StringTable()
+companies = StringTable()
+
+
+class BusColumns:
+    """
+    The buses of one fetch as one list per field of the frontend format
+
+    Records are read field by field as they are decoded, with the same
+    fallbacks the frontend format has always used, and then dropped.
+    """
+
+    FIELDS = (
+        "id", "line", "order", "latitude", "longitude", "heading", "speed",
+        "destination", "timestamp", "company", "subline"
+    )
+
+    def __init__(self):
+        self.values = {field: [] for field in self.FIELDS}
+
+    def __len__(self):
+        return len(self.values["id"])
+
+    def extend(self, records):
+        """Add raw API bus records, skipping those without coordinates"""
+        (ids, line, order, latitude, longitude, heading, speed,
+         destination, timestamp, company, subline) = (self.values[field] for field in self.FIELDS)
+        now = datetime.now().isoformat()
+        for bus in records:
+            try:
+                coordinates = bus["location"]["coordinates"]
+                # API returns [longitude, latitude]
+                bus_longitude, bus_latitude = coordinates[0], coordinates[1]
+            except (KeyError, IndexError, TypeError):
+                continue
+            if bus_latitude is None or bus_longitude is None:
+                continue
+            get = bus.get
+            bus_line = get("line", "unknown")
+            ids.append(bus["id"] if "id" in bus else f"{bus_line}-{get('busId', 'unknown')}")
+            line.append(bus_line)
+            order.append(get("order", 1))
+            latitude.append(bus_latitude)
+            longitude.append(bus_longitude)
+            heading.append(bus["heading"] if "heading" in bus else get("direction", 0))
+            speed.append(get("speed", 0))
+            destination.append(get("destination", get("subline", "Unknown")))
+            timestamp.append(get("timestamp", now))
+            company.append(get("company", ""))
+            subline.append(get("subline", ""))
+
+    def extend_formatted(self, buses):
+        """Add buses already in the frontend format"""
+        for field, values in self.values.items():
+            values.extend(bus.get(field, "") for bus in buses)
+
+    def line_counts(self):
+        """Number of buses per line"""
+        return collections.Counter(str(line) for line in self.values["line"])
+
+    @classmethod
+    def merge(cls, parts):
+        """Concatenate several fetches, keeping the first row of each bus id"""
+        merged = cls()
+        seen = set()
+        for part in parts:
+            rows = []
+            for row, bus_id in enumerate(part.values["id"]):
+                if bus_id not in seen:
+                    seen.add(bus_id)
+                    rows.append(row)
+            for field, values in merged.values.items():
+                column = part.values[field]
+                values.extend(column[row] for row in rows)
+        return merged
+
+
+class Snapshot:
+    """
+    One refresh of the fleet, stored column by column
+
+    `columns` keeps the BusColumns the snapshot was built from; `bus(row)`
+    and `buses` turn them back into the dicts served by /api/buses. The
+    array attributes hold the same data for vectorized stages.
+    `fetched_lines` is None for the whole fleet, or the set of lines
+    fetched when the snapshot was built line by line. The stages that run
+    on each new snapshot attach what they derive from it: `headways`,
+    `wire`, `index` and, for whole-fleet snapshots, `heatmap`.
+    """
+
+    def __init__(self, columns, taken_at=None, fetched_lines=None):
+        self.columns = columns
+        self.taken_at = taken_at if taken_at is not None else time.time()
+        self.fetched_lines = fetched_lines
+        self._buses = None
+        self.headways = None
+        self.wire = None
+        self.index = None
+        self.heatmap = None
+
+        values = columns.values
+        count = len(columns)
+        self.vehicle = vehicles.encode(values["id"], count)
+        self.line = lines.encode(values["line"], count)
+        self.subline = sublines.encode(values["subline"], count)
+        self.destination = destinations.encode(values["destination"], count)
+        self.company = companies.encode(values["company"], count)
+        self.latitude = to_floats(values["latitude"], np.float64)
+        self.longitude = to_floats(values["longitude"], np.float64)
+        self.heading = to_floats(values["heading"], np.float32)
+        self.speed = to_floats(values["speed"], np.float32)
+
+    def __len__(self):
+        return len(self.vehicle)
+
+    def bus(self, row):
+        """The bus at a row, as a frontend dict"""
+        return {field: values[row] for field, values in self.columns.values.items()}
+
+    @property
+    def buses(self):
+        """Every bus as a frontend dict, built on first use"""
+        if self._buses is None:
+            fields = self.columns.FIELDS
+            self._buses = [dict(zip(fields, row)) for row in zip(*self.columns.values.values())]
+        return self._buses
+
+    def covers(self, lines):
+        """Whether the snapshot holds the given lines (None: the whole fleet)"""
+        if self.fetched_lines is None:
+            return True
+        return lines is not None and self.fetched_lines.issuperset(str(line) for line in lines)
+
+
+class PositionStore:
+    """
+    Recorded bus positions as growable columnar arrays ordered by time
+
+    Rows hold one bus each; a separate time index holds, per snapshot, its
+    timestamp and the number of its first row, so the time is not repeated
+    on every row. Row numbers count every row ever appended; `_base` is the
+    number of the first row in the current arrays. Rows are only ever
+    written past the current end, and compaction copies into fresh arrays,
+    so views handed out by `window()` stay valid while new snapshots are
+    appended.
+    """
+
+    # Line and subline codes stay far below 2**15, and positions in float32
+    # are within half a metre
+    COLUMNS = (
+        ("vehicle", np.int32),
+        ("line", np.int16),
+        ("subline", np.int16),
+        ("latitude", np.float32),
+        ("longitude", np.float32),
+        ("speed", np.float16),
+    )
+    INDEX = (
+        ("t", np.int64),
+        ("row", np.int64),
+    )
+    # Full arrays are reallocated with this much room for the live entries
+    GROWTH = 1.5
+
+    def __init__(self, retention, initial_capacity=1 << 16):
+        self.retention = retention
+        self._columns = {name: np.empty(initial_capacity, dtype=dtype) for name, dtype in self.COLUMNS}
+        self._base = 0
+        self._rows = 0
+        self._index = {name: np.empty(1024, dtype=dtype) for name, dtype in self.INDEX}
+        self._first = 0
+        self._last = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._rows - self._first_row()
+
+    @property
+    def earliest_time(self):
+        """Timestamp of the oldest retained snapshot, or None if empty"""
+        with self._lock:
+            if self._last == self._first:
+                return None
+            return int(self._index["t"][self._first])
+
+    @property
+    def latest_time(self):
+        """Timestamp of the last recorded snapshot, or None if empty"""
+        with self._lock:
+            if self._last == self._first:
+                return None
+            return int(self._index["t"][self._last - 1])
+
+    def append(self, snapshot):
+        """Record every bus of a snapshot and drop rows past the retention"""
+        count = len(snapshot)
+        timestamp = int(snapshot.taken_at)
+        with self._lock:
+            self._evict(timestamp - self.retention)
+            if self._last == len(self._index["t"]):
+                self._index = self._resize(self._index, self._first, self._last, 1)
+                self._first, self._last = 0, self._last - self._first
+            self._index["t"][self._last] = timestamp
+            self._index["row"][self._last] = self._rows
+            self._last += 1
+
+            if self._rows + count - self._base > len(self._columns["vehicle"]):
+                first_row = self._first_row()
+                self._columns = self._resize(self._columns, first_row - self._base, self._rows - self._base, count)
+                self._base = first_row
+            rows = slice(self._rows - self._base, self._rows - self._base + count)
+            columns = self._columns
+            columns["vehicle"][rows] = snapshot.vehicle
+            columns["line"][rows] = snapshot.line
+            columns["subline"][rows] = snapshot.subline
+            columns["latitude"][rows] = snapshot.latitude
+            columns["longitude"][rows] = snapshot.longitude
+            columns["speed"][rows] = snapshot.speed
+            self._rows += count
+
+    def window(self, start=None, end=None):
+        """
+        Return column views for rows with start <= t < end, with their
+        times in a "t" column
+        """
+        # Compaction swaps in new arrays and offsets together, so read them
+        # under the lock; the views stay valid once it is released
+        with self._lock:
+            columns, base, rows = self._columns, self._base, self._rows
+            t = self._index["t"][self._first:self._last]
+            first_rows = self._index["row"][self._first:self._last]
+        lo = 0 if start is None else int(np.searchsorted(t, start, side="left"))
+        hi = len(t) if end is None else int(np.searchsorted(t, end, side="left"))
+        row_hi = int(first_rows[hi]) if hi < len(t) else rows
+        starts = first_rows[lo:hi]
+        row_lo = int(starts[0]) if len(starts) else row_hi
+        window = {"t": np.repeat(t[lo:hi], np.diff(starts, append=row_hi))}
+        for name, _ in self.COLUMNS:
+            window[name] = columns[name][row_lo - base:row_hi - base]
+        return window
+
+    def _first_row(self):
+        if self._last == self._first:
+            return self._rows
+        return int(self._index["row"][self._first])
+
+    def _evict(self, cutoff):
+        t = self._index["t"][self._first:self._last]
+        self._first += int(np.searchsorted(t, cutoff, side="left"))
+
+    def _resize(self, arrays, lo, hi, count):
+        """Copy arrays[lo:hi] into fresh arrays with room for `count` more"""
+        live = hi - lo
+        capacity = len(next(iter(arrays.values())))
+        while capacity < self.GROWTH * (live + count):
+            capacity = int(capacity * self.GROWTH)
+        resized = {}
+        for name, column in arrays.items():
+            resized[name] = np.empty(capacity, dtype=column.dtype)
+            resized[name][:live] = column[lo:hi]
+        return resized
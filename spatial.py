@@ -0,0 +1,175 @@
+"""
+Spatial index over a fleet snapshot
+
+SnapshotIndex holds array-backed KD-trees: one over the whole fleet and one
+per line. Every tree is implicit: the points of a range [lo, hi) are
+arranged so that the median (lo + hi) // 2 splits them on x at even depths
+and on y at odd depths, with both halves arranged the same way recursively.
+All trees are built together, one vectorized sort per tree level, so the
+rebuild on every refresh costs a handful of NumPy calls.
+
+pairs_within() is the static counterpart for stops: a grid join returning
+every pair of points closer than a radius, used for walking transfers.
+"""
+import heapq
+import math
+
+import numpy as np
+
+from analytics import METERS_PER_DEGREE, haversine
+
+
+def bearing(lat1, lng1, lat2, lng2):
+    """Initial compass bearing in degrees from the first point to the second"""
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(a, dtype=np.float64)) for a in (lat1, lng1, lat2, lng2))
+    dlng = lng2 - lng1
+    y = np.sin(dlng) * np.cos(lat2)
+    x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(dlng)
+    return np.mod(np.degrees(np.arctan2(y, x)), 360)
+
+
+def build_kd_ranges(x, y, lo, hi):
+    """
+    Arrange points into implicit KD-trees, one per [lo, hi) range
+
+    Returns the permutation to apply to the input points.
+    """
+    permutation = np.arange(len(x))
+    x = x.copy()
+    y = y.copy()
+    lo = np.asarray(lo, dtype=np.int64)
+    hi = np.asarray(hi, dtype=np.int64)
+    depth = 0
+    while True:
+        keep = hi - lo > 1
+        lo, hi = lo[keep], hi[keep]
+        if not len(lo):
+            return permutation
+
+        # Positions covered by the current segments, and their segment id
+        sizes = hi - lo
+        starts = np.cumsum(sizes) - sizes
+        segment = np.repeat(np.arange(len(lo)), sizes)
+        position = np.arange(int(sizes.sum())) - np.repeat(starts, sizes) + np.repeat(lo, sizes)
+
+        # Sort every segment on this depth's axis; segments stay in place
+        coordinate = x if depth % 2 == 0 else y
+        arranged = position[np.lexsort((coordinate[position], segment))]
+        for array in (permutation, x, y):
+            array[position] = array[arranged]
+
+        mid = (lo + hi) // 2
+        lo, hi = np.concatenate((lo, mid + 1)), np.concatenate((mid, hi))
+        depth += 1
+
+
+class SnapshotIndex:
+    """
+    Nearest-vehicle lookups over one snapshot, for the fleet or a line
+    """
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        count = len(snapshot)
+        self.reference_latitude = float(np.mean(snapshot.latitude)) if count else 0.0
+
+        # The fleet tree comes first, followed by one tree per line
+        by_line = np.argsort(snapshot.line, kind="stable")
+        codes, line_starts, line_counts = np.unique(snapshot.line[by_line], return_index=True, return_counts=True)
+        lo = np.concatenate(([0], count + line_starts))
+        hi = np.concatenate(([count], count + line_starts + line_counts))
+        self.line_ranges = {int(code): (int(start), int(end)) for code, start, end in zip(codes, lo[1:], hi[1:])}
+
+        rows = np.concatenate((np.arange(count), by_line))
+        x, y = self.project(snapshot.latitude[rows], snapshot.longitude[rows])
+        permutation = build_kd_ranges(x, y, lo, hi)
+
+        # Plain lists: scalar access during the search is much faster
+        self._rows = rows[permutation].tolist()
+        self._x = x[permutation].tolist()
+        self._y = y[permutation].tolist()
+
+    def project(self, latitude, longitude):
+        x = np.asarray(longitude) * METERS_PER_DEGREE * math.cos(math.radians(self.reference_latitude))
+        y = np.asarray(latitude) * METERS_PER_DEGREE
+        return x, y
+
+    def nearest(self, latitude, longitude, k, line_code=None):
+        """
+        Return (rows, distances_m, bearings_deg) of the k closest buses
+
+        `rows` index into the snapshot, closest first. Bearings are measured
+        from the query point towards each bus.
+        """
+        if line_code is None:
+            lo, hi = 0, len(self.snapshot)
+        else:
+            lo, hi = self.line_ranges.get(line_code, (0, 0))
+        qx, qy = (float(v) for v in self.project(latitude, longitude))
+
+        heap = []
+        self._search(lo, hi, 0, qx, qy, k, heap)
+        found = sorted((-negative, index) for negative, index in heap)
+        rows = np.array([self._rows[index] for _, index in found], dtype=np.int64)
+
+        snapshot = self.snapshot
+        bus_latitude = snapshot.latitude[rows]
+        bus_longitude = snapshot.longitude[rows]
+        distances = haversine(latitude, longitude, bus_latitude, bus_longitude)
+        bearings = bearing(latitude, longitude, bus_latitude, bus_longitude)
+        return rows, distances, bearings
+
+    def _search(self, lo, hi, depth, qx, qy, k, heap):
+        # heap holds (-squared distance, index): the worst match is on top
+        if lo >= hi:
+            return
+        mid = (lo + hi) // 2
+        dx = qx - self._x[mid]
+        dy = qy - self._y[mid]
+        distance = dx * dx + dy * dy
+        if len(heap) < k:
+            heapq.heappush(heap, (-distance, mid))
+        elif distance < -heap[0][0]:
+            heapq.heapreplace(heap, (-distance, mid))
+
+        split = dx if depth % 2 == 0 else dy
+        if split < 0:
+            near, far = (lo, mid), (mid + 1, hi)
+        else:
+            near, far = (mid + 1, hi), (lo, mid)
+        self._search(near[0], near[1], depth + 1, qx, qy, k, heap)
+        if len(heap) < k or split * split < -heap[0][0]:
+            self._search(far[0], far[1], depth + 1, qx, qy, k, heap)
+
+
+def pairs_within(x, y, radius):
+    """
+    All ordered pairs of distinct points closer than `radius`
+
+    Points are bucketed in a grid of `radius`-sized cells and each cell is
+    matched against its 3x3 neighbourhood with searchsorted. Returns
+    (i, j, distance) arrays.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    cell_x = np.floor((x - x.min()) / radius).astype(np.int64) if len(x) else np.zeros(0, dtype=np.int64)
+    cell_y = np.floor((y - y.min()) / radius).astype(np.int64) if len(y) else np.zeros(0, dtype=np.int64)
+    width = int(cell_y.max()) + 3 if len(y) else 1
+    key = (cell_x + 1) * width + cell_y + 1
+    order = np.argsort(key)
+    sorted_key = key[order]
+
+    first, second = [], []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            neighbour = key + dx * width + dy
+            lo = np.searchsorted(sorted_key, neighbour, side="left")
+            counts = np.searchsorted(sorted_key, neighbour, side="right") - lo
+            starts = np.cumsum(counts) - counts
+            first.append(np.repeat(np.arange(len(key)), counts))
+            second.append(order[np.repeat(lo - starts, counts) + np.arange(int(counts.sum()))])
+    i = np.concatenate(first)
+    j = np.concatenate(second)
+    distance = np.hypot(x[i] - x[j], y[i] - y[j])
+    keep = (i != j) & (distance <= radius)
+    return i[keep], j[keep], distance[keep]
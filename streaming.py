@@ -0,0 +1,222 @@
+"""
+Incremental decoding of large JSON arrays
+
+The /buses and /buses/busstops endpoints return one big JSON array. Instead
+of buffering the whole body, iter_json_batches() decodes it while it is
+still arriving and hands out the elements in batches, so callers can pull
+the fields they need into columns and drop each batch right away.
+
+Each new stretch of the body is scanned once with NumPy for the structure
+of the array: unescaped quotes give the string spans, and the brackets and
+commas outside them give the nesting depth and the commas that separate
+top-level elements. The scan state (depth, inside a string, pending
+backslash) carries over to the next chunk, so nothing is rescanned however
+the body is split. All complete elements found in a scan are then decoded
+by a single json.loads call. Small chunks are coalesced before scanning.
+"""
+import json
+
+import numpy as np
+
+# Bytes gathered before a scan, so tiny chunks do not mean tiny scans
+MIN_SCAN_BYTES = 16 * 1024
+WHITESPACE = b" \t\n\r"
+
+QUOTE = ord('"')
+BACKSLASH = ord("\\")
+COMMA = 2
+
+# Per byte: +1 opens a container, -1 closes one, COMMA separates values
+STRUCTURE = np.zeros(256, dtype=np.int8)
+STRUCTURE[[ord("{"), ord("[")]] = 1
+STRUCTURE[[ord("}"), ord("]")]] = -1
+STRUCTURE[ord(",")] = COMMA
+
+
+class NotAnArray(json.JSONDecodeError):
+    """
+    The document is valid JSON but not an array; `value` holds it decoded
+    """
+
+    def __init__(self, value, doc):
+        super().__init__("Expecting a JSON array", doc, 0)
+        self.value = value
+
+
+def iter_json_batches(chunks):
+    """
+    Yield lists of the elements of a top-level JSON array from byte or text
+    chunks, each list holding the elements completed since the last one
+
+    Raises NotAnArray if the document holds some other JSON value, and
+    json.JSONDecodeError if it is malformed or truncated; batches before
+    the error have been yielded.
+    """
+    pending = bytearray()
+    scanned = 0
+    depth, in_string, escaped = 1, False, False
+    after_comma = False
+    state = "start"
+    chunks = iter(chunks)
+    final = False
+
+    while not final:
+        chunk = next(chunks, None)
+        if chunk is None:
+            final = True
+        else:
+            pending += chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+            if len(pending) - scanned < MIN_SCAN_BYTES:
+                continue
+
+        if state == "start":
+            body = pending.lstrip(WHITESPACE)
+            if body[:1] == b"[":
+                del pending[:len(pending) - len(body) + 1]
+                state = "guess"
+            elif body or final:
+                # Anything else is buffered whole and decoded at the end
+                state = "other"
+            else:
+                continue
+
+        if state == "other":
+            if final:
+                doc = pending.decode("utf-8")
+                raise NotAnArray(json.loads(doc), doc)
+            scanned = len(pending)
+
+        elif state == "end":
+            if pending.strip(WHITESPACE):
+                doc = pending.decode("utf-8", "replace")
+                raise json.JSONDecodeError("Extra data", doc, len(doc) - len(doc.lstrip()))
+            pending.clear()
+            scanned = 0
+
+        elif state == "guess" and final:
+            # The rest holds the last elements and the closing bracket
+            if after_comma and pending.strip(WHITESPACE) == b"]":
+                raise json.JSONDecodeError("Expecting value", pending.decode("utf-8"), 0)
+            batch = json.loads(b"[" + pending)
+            state = "end"
+            if batch:
+                yield batch
+
+        elif state == "guess":
+            # Objects in the array are separated by "},{". A cut at such a
+            # break inside a string or a nested value leaves the batch
+            # unbalanced, so it fails to parse and the exact scan takes over
+            cut = last_object_break(pending, max(scanned - 2, 0))
+            scanned = len(pending)
+            if cut >= 0:
+                try:
+                    batch = json.loads(b"[" + pending[:cut + 1] + b"]")
+                except ValueError:
+                    state = "scan"
+                    scanned = 0
+                else:
+                    del pending[:pending.index(b",", cut) + 1]
+                    scanned = len(pending)
+                    after_comma = True
+                    yield batch
+
+        if state == "scan":
+            separators, end, depth, in_string, escaped = scan(
+                memoryview(pending)[scanned:], depth, in_string, escaped
+            )
+            if end >= 0:
+                stop = scanned + end
+            elif len(separators):
+                stop = scanned + int(separators[-1])
+            else:
+                scanned = len(pending)
+                continue
+            elements = pending[:stop]
+            # Only the closing bracket of an empty array may follow nothing
+            if not elements.strip(WHITESPACE) and (end < 0 or after_comma):
+                raise json.JSONDecodeError("Expecting value", pending.decode("utf-8", "replace"), stop)
+            batch = json.loads(b"[" + elements + b"]")
+            del pending[:stop + 1]
+            scanned = len(pending)
+            after_comma = end < 0
+            if end >= 0:
+                state = "end"
+                if pending.strip(WHITESPACE):
+                    doc = pending.decode("utf-8", "replace")
+                    raise json.JSONDecodeError("Extra data", doc, len(doc) - len(doc.lstrip()))
+            if batch:
+                yield batch
+
+    if state != "end":
+        raise json.JSONDecodeError("Unexpected end of data", pending.decode("utf-8", "replace"), len(pending))
+
+
+def last_object_break(data, start):
+    """
+    Offset of the "}" in the last "},{" of data[start:], whitespace allowed
+    around the comma, or -1
+    """
+    end = len(data)
+    while True:
+        brace = data.rfind(b"{", start, end)
+        if brace < 0:
+            return -1
+        window = max(brace - 16, start)
+        before = data[window:brace].rstrip(WHITESPACE)
+        if before.endswith(b","):
+            before = before[:-1].rstrip(WHITESPACE)
+            if before.endswith(b"}"):
+                return window + len(before) - 1
+        end = brace
+
+
+def scan(view, depth, in_string, escaped):
+    """
+    Scan a stretch of an array body for its top-level structure
+
+    `depth` is the nesting depth where the stretch starts (1 right inside
+    the array), `in_string` whether it starts inside a string and `escaped`
+    whether its first byte is escaped by a backslash. Returns the offsets
+    of the commas between top-level elements, the offset of the closing
+    bracket or -1, and the state at the end of the stretch.
+    """
+    data = np.frombuffer(view, dtype=np.uint8)
+    quotes = np.flatnonzero(data == QUOTE)
+
+    # A backslash escapes the next byte unless it is escaped itself: within
+    # a run of backslashes every other one is active
+    backslashes = np.flatnonzero(data == BACKSLASH)
+    if len(backslashes) or escaped:
+        index = np.arange(len(backslashes))
+        run_start = np.diff(backslashes, prepend=-2) != 1
+        rank = index - np.maximum.accumulate(np.where(run_start, index, 0))
+        if escaped:
+            # The run at the very start is shifted by the carried backslash
+            rank[backslashes == index] += 1
+        escaped_bytes = backslashes[rank % 2 == 0] + 1
+        if escaped:
+            escaped_bytes = np.concatenate(([0], escaped_bytes))
+        quotes = quotes[~np.isin(quotes, escaped_bytes)]
+        escaped = bool(len(escaped_bytes)) and int(escaped_bytes[-1]) == len(data)
+
+    # Brackets and commas count only outside strings, i.e. after an even
+    # number of quotes when the stretch starts outside one
+    kind = STRUCTURE[data]
+    structural = np.flatnonzero(kind)
+    outside = np.searchsorted(quotes, structural) % 2 == int(in_string)
+    structural = structural[outside]
+    kind = kind[structural]
+    in_string ^= len(quotes) % 2 == 1
+
+    delta = np.where(kind == COMMA, 0, kind)
+    level = depth + np.cumsum(delta) - delta
+    closing = np.flatnonzero((delta == -1) & (level == 1))
+    end = int(structural[closing[0]]) if len(closing) else -1
+    top = (kind == COMMA) & (level == 1)
+    if end >= 0:
+        if len(structural) > closing[0] + 1:
+            doc = bytes(view).decode("utf-8", "replace")
+            raise json.JSONDecodeError("Extra data", doc, int(structural[closing[0] + 1]))
+        top &= structural < end
+    depth += int(delta.sum())
+    return structural[top], end, depth, in_string, escaped
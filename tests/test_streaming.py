@@ -0,0 +1,143 @@
+import json
+import unittest
+
+import streaming
+
+
+# An object with "},{" inside a string: a batch cut there does not parse,
+# so the decoder falls back to the exact scan
+DECOY = '{"s": "},{"}'
+
+
+def decode(text, chunk_size, min_scan_bytes=0, scans=None):
+    """
+    Decode a body split into chunks of `chunk_size` bytes, flattening
+    batches; the length of each stretch passed to scan() is appended to
+    `scans` (keeping the view itself would pin the decoder's buffer)
+    """
+    data = text.encode("utf-8")
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+    saved = streaming.MIN_SCAN_BYTES, streaming.scan
+
+    def scan(*args):
+        if scans is not None:
+            scans.append(len(args[0]))
+        return saved[1](*args)
+
+    streaming.MIN_SCAN_BYTES, streaming.scan = min_scan_bytes, scan
+    try:
+        return [element for batch in streaming.iter_json_batches(chunks) for element in batch]
+    finally:
+        streaming.MIN_SCAN_BYTES, streaming.scan = saved
+
+
+class IterJsonBatchesTest(unittest.TestCase):
+
+    CHUNK_SIZES = (1, 2, 3, 7, 64, 1 << 16)
+    MIN_SCAN_BYTES = (0, 7, 64, streaming.MIN_SCAN_BYTES)
+    # `scanned` checks the scan path was taken; only without coalescing, as
+    # a short body otherwise arrives whole and is decoded in one go
+
+    def assertDecodes(self, text, scanned=False):
+        expected = json.loads(text)
+        for chunk_size in self.CHUNK_SIZES:
+            for min_scan_bytes in self.MIN_SCAN_BYTES:
+                with self.subTest(chunk_size=chunk_size, min_scan_bytes=min_scan_bytes):
+                    scans = []
+                    self.assertEqual(decode(text, chunk_size, min_scan_bytes, scans), expected)
+                    if scanned and min_scan_bytes == 0:
+                        self.assertTrue(scans)
+
+    def assertRejects(self, text, scanned=False):
+        for chunk_size in self.CHUNK_SIZES:
+            for min_scan_bytes in self.MIN_SCAN_BYTES:
+                with self.subTest(chunk_size=chunk_size, min_scan_bytes=min_scan_bytes):
+                    scans = []
+                    with self.assertRaises(json.JSONDecodeError) as raised:
+                        decode(text, chunk_size, min_scan_bytes, scans)
+                    self.assertNotIsInstance(raised.exception, streaming.NotAnArray)
+                    if scanned and min_scan_bytes == 0:
+                        self.assertTrue(scans)
+
+    def test_objects(self):
+        buses = [{"busId": i, "line": str(100 + i), "location": {"coordinates": [-56.1, -34.9]}} for i in range(50)]
+        self.assertDecodes(json.dumps(buses))
+        self.assertDecodes(json.dumps(buses, indent=2))
+
+    def test_escaped_quotes(self):
+        elements = r'{"name": "say \"hi\""}, {"name": "back\\slash\\"}, "\"]\"", {"a": "\\\\\"},{"}'
+        self.assertDecodes(f"[{elements}]")
+        self.assertDecodes(f"[{DECOY}, {elements}, {DECOY}]", scanned=True)
+
+    def test_object_break_inside_strings(self):
+        self.assertDecodes(json.dumps([{"a": "},{"}, {"b": "x},{y"}, {"c": "}, {"}]), scanned=True)
+        self.assertDecodes(json.dumps([{"a": [{"x": 1}, {"y": 2}]}, {"b": {"c": "},{"}}]), scanned=True)
+
+    def test_mixed_values(self):
+        self.assertDecodes(json.dumps([1, "two", None, True, [3, [4]], {"five": 5}, -2.5e10, "é"], ensure_ascii=False))
+
+    def test_empty_array(self):
+        self.assertDecodes("[]")
+        self.assertDecodes(" \n[ \n] \n")
+
+    def test_trailing_comma(self):
+        self.assertRejects("[1,]")
+        self.assertRejects('[{"a": 1},]')
+        self.assertRejects('[{"a": 1}, {"b": 2} , ]')
+        self.assertRejects(f'[{{"a": 1}}, {DECOY},]', scanned=True)
+        self.assertRejects(f'[{{"a": 1}}, {DECOY}, 2 , ]', scanned=True)
+
+    def test_missing_elements(self):
+        for text in ("[,1]", "[,]", "[1,,2]", "[1 2]"):
+            with self.subTest(text=text):
+                self.assertRejects(text)
+        self.assertRejects(f"[{DECOY}, {DECOY},, 1]", scanned=True)
+
+    def test_truncated(self):
+        for text in ("", "   ", "[", "[1,2", '["a]', '[{"a": 1}, {"b": 2}'):
+            with self.subTest(text=text):
+                self.assertRejects(text)
+
+    def test_extra_data(self):
+        for text in ("[1]x", "[1],[2]", "[1]]", '[{"a": 1}] {}', f"[{DECOY}, {DECOY}] {{}}"):
+            with self.subTest(text=text):
+                self.assertRejects(text)
+
+    def test_not_an_array(self):
+        for text in ('{"message": "no buses"}', " 5 ", '"x"', "null"):
+            for chunk_size in self.CHUNK_SIZES:
+                with self.subTest(text=text, chunk_size=chunk_size):
+                    with self.assertRaises(streaming.NotAnArray) as raised:
+                        decode(text, chunk_size)
+                    self.assertEqual(raised.exception.value, json.loads(text))
+
+    def test_batches_arrive_before_the_end(self):
+        data = json.dumps([{"busId": i} for i in range(5000)]).encode()
+        read = []
+
+        def chunks():
+            for i in range(0, len(data), 1024):
+                read.append(i + 1024)
+                yield data[i:i + 1024]
+
+        batches = streaming.iter_json_batches(chunks())
+        first = next(batches)
+        self.assertLess(read[-1], len(data))
+        self.assertEqual(first + [bus for batch in batches for bus in batch], json.loads(data))
+
+
+class ScanTest(unittest.TestCase):
+
+    def test_state_carries_over(self):
+        # One array body scanned in two stretches, split inside an escape
+        body = b'"a\\\\", {"b": "\\"]"}, 3]'
+        split = body.index(b"\\") + 1
+        separators, end, depth, in_string, escaped = streaming.scan(memoryview(body[:split]), 1, False, False)
+        self.assertEqual((end, depth, in_string, escaped), (-1, 1, True, True))
+        separators, end, depth, in_string, escaped = streaming.scan(memoryview(body[split:]), depth, in_string, escaped)
+        self.assertEqual([split + int(offset) for offset in separators], [body.index(b","), body.rindex(b",")])
+        self.assertEqual(split + end, len(body) - 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
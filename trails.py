@@ -0,0 +1,100 @@
+"""
+Recent trajectory of every bus
+
+TrailBuffer keeps a fixed-size ring of positions per vehicle in 2-D arrays
+indexed by vehicle code, so memory is bounded by fleet size times trail
+length and a lookup by bus id is a single table access. Each snapshot is
+appended to all rings at once with fancy indexing.
+
+Trails are served as encoded polylines (the Google polyline algorithm),
+which Leaflet clients can decode in a few lines.
+"""
+import numpy as np
+
+import snapshots
+
+POLYLINE_PRECISION = 1e5
+
+
+class TrailBuffer:
+    """
+    Per-vehicle ring buffers of (time, latitude, longitude)
+    """
+
+    def __init__(self, length, initial_vehicles=1024):
+        self.length = length
+        self.t = np.zeros((initial_vehicles, length), dtype=np.float64)
+        self.latitude = np.zeros((initial_vehicles, length), dtype=np.float32)
+        self.longitude = np.zeros((initial_vehicles, length), dtype=np.float32)
+        self.head = np.zeros(initial_vehicles, dtype=np.int32)
+        self.count = np.zeros(initial_vehicles, dtype=np.int32)
+
+    def append(self, snapshot):
+        """Push every bus of a snapshot onto its ring"""
+        self._reserve(len(snapshots.vehicles))
+        vehicle = snapshot.vehicle
+        slot = self.head[vehicle]
+        self.t[vehicle, slot] = snapshot.taken_at
+        self.latitude[vehicle, slot] = snapshot.latitude
+        self.longitude[vehicle, slot] = snapshot.longitude
+        self.head[vehicle] = (slot + 1) % self.length
+        self.count[vehicle] = np.minimum(self.count[vehicle] + 1, self.length)
+
+    def trail(self, vehicle_code, since):
+        """Return (t, latitude, longitude) of a vehicle from `since`, oldest first"""
+        if vehicle_code < 0 or vehicle_code >= len(self.head):
+            empty = np.zeros(0)
+            return empty, empty, empty
+        count = int(self.count[vehicle_code])
+        slots = (int(self.head[vehicle_code]) - count + np.arange(count)) % self.length
+        t = self.t[vehicle_code, slots]
+        recent = t >= since
+        return t[recent], self.latitude[vehicle_code, slots][recent], self.longitude[vehicle_code, slots][recent]
+
+    def _reserve(self, vehicles):
+        capacity = len(self.head)
+        if vehicles <= capacity:
+            return
+        while capacity < vehicles:
+            capacity *= 2
+        for name in ("t", "latitude", "longitude"):
+            array = getattr(self, name)
+            grown = np.zeros((capacity, self.length), dtype=array.dtype)
+            grown[:len(array)] = array
+            setattr(self, name, grown)
+        for name in ("head", "count"):
+            array = getattr(self, name)
+            grown = np.zeros(capacity, dtype=array.dtype)
+            grown[:len(array)] = array
+            setattr(self, name, grown)
+
+
+def encode_signed(value, chunks):
+    """Append one signed integer in polyline encoding to `chunks`"""
+    value = ~(value << 1) if value < 0 else value << 1
+    while value >= 0x20:
+        chunks.append(chr((0x20 | (value & 0x1F)) + 63))
+        value >>= 5
+    chunks.append(chr(value + 63))
+
+
+def encode_values(values):
+    """Encode a sequence of integers as polyline deltas"""
+    chunks = []
+    previous = 0
+    for value in values:
+        encode_signed(value - previous, chunks)
+        previous = value
+    return "".join(chunks)
+
+
+def encode_polyline(latitude, longitude):
+    """Encode coordinates with the Google polyline algorithm"""
+    lat = np.round(np.asarray(latitude, dtype=np.float64) * POLYLINE_PRECISION).astype(np.int64)
+    lng = np.round(np.asarray(longitude, dtype=np.float64) * POLYLINE_PRECISION).astype(np.int64)
+    # Interleave the deltas of both coordinates: lat0, lng0, lat1, lng1, ...
+    deltas = np.diff(np.column_stack((lat, lng)), axis=0, prepend=0).ravel()
+    chunks = []
+    for delta in deltas.tolist():
+        encode_signed(delta, chunks)
+    return "".join(chunks)
@@ -0,0 +1,97 @@
+"""
+Compact binary wire format for fleet snapshots
+
+Served at /api/buses.bin as an alternative to the JSON list. Layout, all
+little-endian:
+
+    header   magic "MVDB", version u16, record size u16, taken_at f64,
+             bus count u32, string block length u32            (24 bytes)
+    strings  UTF-8 strings separated by NUL, padded to 4 bytes
+    records  one fixed-width RECORD per bus
+
+Strings (ids, lines, sublines, destinations, companies) are stored once in
+the string block and referenced by index. Coordinates are fixed-point
+microdegrees (about 0.1 m), and the bus timestamp is an offset in seconds
+from the snapshot time. The payload is built once per snapshot and the same
+bytes are served to every client.
+"""
+import struct
+from datetime import datetime
+
+import numpy as np
+
+import snapshots
+
+MAGIC = b"MVDB"
+VERSION = 1
+HEADER = struct.Struct("<4sHHdII")
+COORDINATE_SCALE = 1e6
+
+RECORD = np.dtype([
+    ("id", "<u4"),
+    ("latitude", "<i4"),
+    ("longitude", "<i4"),
+    ("age", "<i4"),
+    ("line", "<u2"),
+    ("subline", "<u2"),
+    ("destination", "<u2"),
+    ("company", "<u2"),
+    ("heading", "<u2"),
+    ("speed", "u1"),
+    ("reserved", "u1"),
+])
+
+# (record field, Snapshot attribute, string table) of each string column
+STRING_COLUMNS = (
+    ("id", "vehicle", snapshots.vehicles),
+    ("line", "line", snapshots.lines),
+    ("subline", "subline", snapshots.sublines),
+    ("destination", "destination", snapshots.destinations),
+    ("company", "company", snapshots.companies),
+)
+
+
+def bus_age(timestamp, taken_at):
+    """Seconds between a bus's own timestamp and the snapshot"""
+    try:
+        timestamp = datetime.fromisoformat(str(timestamp)).timestamp()
+    except ValueError:
+        return 0
+    return int(round(taken_at - timestamp))
+
+
+class SnapshotEncoder:
+    """
+    Packs snapshots into the binary format, reusing one record buffer
+    """
+
+    def __init__(self):
+        self._records = np.zeros(0, dtype=RECORD)
+
+    def encode(self, snapshot):
+        """Return the binary payload for a snapshot"""
+        count = len(snapshot)
+        if len(self._records) < count:
+            self._records = np.zeros(max(count, 2 * len(self._records)), dtype=RECORD)
+        records = self._records[:count]
+
+        # Per-snapshot string table holding only the strings in use
+        strings = []
+        for field, attribute, table in STRING_COLUMNS:
+            codes, local = np.unique(getattr(snapshot, attribute), return_inverse=True)
+            records[field] = local + len(strings)
+            strings.extend(table.decode(codes))
+        string_block = "\0".join(strings).encode("utf-8")
+        string_block += b"\0" * (-len(string_block) % 4)
+
+        records["latitude"] = np.round(snapshot.latitude * COORDINATE_SCALE)
+        records["longitude"] = np.round(snapshot.longitude * COORDINATE_SCALE)
+        records["heading"] = np.mod(np.round(snapshot.heading), 360)
+        records["speed"] = np.clip(np.round(snapshot.speed), 0, 255)
+        # Buses report in step, so the same timestamps repeat across the fleet
+        timestamps = snapshot.columns.values["timestamp"]
+        ages = {timestamp: bus_age(timestamp, snapshot.taken_at) for timestamp in set(timestamps)}
+        records["age"] = np.fromiter((ages[timestamp] for timestamp in timestamps), dtype=np.int32, count=count)
+
+        header = HEADER.pack(MAGIC, VERSION, RECORD.itemsize, snapshot.taken_at, count, len(string_block))
+        return b"".join((header, string_block, records.tobytes()))